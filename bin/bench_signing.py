@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+from Cryptodome.PublicKey import ECC
+from ndn.encoding import Name, MetaInfo, Component, make_data
+from ndn.security import Sha256WithEcdsaSigner, DigestSha256Signer, HmacSha256Signer
+from gitsync.sync.fetch_queue import SEGMENT_SIZES
+
+
+def bench(signer, seg_size: int, count: int) -> float:
+    # Packets signed per second, with the names and meta info of object segments
+    prefix = Name.from_str('/gitsync/project/bench.git/objects')
+    content = os.urandom(seg_size)
+    meta = MetaInfo(freshness_period=3600000, final_block_id=Component.from_segment(count - 1))
+    start = time.perf_counter()
+    for seg_no in range(count):
+        make_data(prefix + [Component.from_bytes(content[:20]), Component.from_segment(seg_no)],
+                  meta, content, signer=signer)
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    key_name = Name.from_str('/gitsync/KEY/bench')
+    signers = {
+        'ecdsa': Sha256WithEcdsaSigner(key_name, ECC.generate(curve='P-256').export_key(format='DER')),
+        'digest': DigestSha256Signer(),
+        'hmac': HmacSha256Signer(key_name, os.urandom(32)),
+    }
+    print(f'{"signer":<8}' + ''.join(f'{seg_size:>12}' for seg_size in SEGMENT_SIZES) + '  (packets/s by segment size)')
+    for name, signer in signers.items():
+        rates = [bench(signer, seg_size, count) for seg_size in SEGMENT_SIZES]
+        print(f'{name:<8}' + ''.join(f'{rate:>12.0f}' for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,17 @@ import os
 import io
 import sys
 import typing
-from git import Repo, Reference
+import tempfile
+from git import Repo, Reference, GitCommandError
 from gitdb.base import IStream
-from ndn.encoding import Name
+from ndn.encoding import Name, DecodeError
 from ndn.app import NDNApp
 from ndn.types import InterestNack, InterestTimeout, InterestCanceled, ValidationFailure
+from gitsync.repos import (ObjectReader, ObjectIndex, CommitGraph, LooseObjectWriter, read_loose_obj,
+                           read_loose_range, loose_obj_crc32, run_git)
 from gitsync.sync.fetch_queue import ObjectFetcher
+from gitsync.sync.pack_fetch import PackFetcher, CLONE_RETRY_TIMES
+from gitsync.sync.signing import object_signer
 from gitsync.sync import packet
 
 
@@ -16,15 +21,63 @@ class GitRepo:
     def __init__(self, repo_name: str, path: str):
         self.repo_name = repo_name
         self.repo = Repo(path)
+        self.git_dir = self.repo.git_dir
+        self.reader = ObjectReader(os.path.join(self.git_dir, 'objects'))
+        self.obj_index = ObjectIndex(os.path.join(self.git_dir, 'objects'))
+        self.commit_graph = CommitGraph(self.reader)
+        self.new_objects = []
 
     def has_obj(self, obj_name: bytes) -> bool:
-        return self.repo.odb.has_object(obj_name)
+        if obj_name in self.obj_index:
+            return True
+        if self.repo.odb.has_object(obj_name):
+            self.obj_index.add_stale(obj_name)
+            return True
+        return False
 
     def store_obj(self, obj_type: bytes, data: bytes) -> bytes:
         istream = IStream(obj_type, len(data), io.BytesIO(data))
         self.repo.odb.store(istream)
+        self.on_stored(istream.binsha)
         return istream.binsha
 
+    def open_writer(self) -> LooseObjectWriter:
+        return LooseObjectWriter(self.git_dir, self.on_stored)
+
+    def on_stored(self, obj_name: bytes):
+        self.obj_index.add(obj_name)
+        self.new_objects.append(obj_name)
+
+    async def write_promisor_pack(self):
+        # In a partial clone, git only accepts missing blobs referred to by objects in a promisor pack
+        if not self.new_objects:
+            return
+        names = ''.join(f'{obj_name.hex()}\n' for obj_name in self.new_objects)
+        pack_base = os.path.join(self.git_dir, 'objects', 'pack', 'pack')
+        pack_hash = await run_git(self.git_dir, 'pack-objects', '-q', pack_base, input=names.encode())
+        pack_hash = pack_hash.decode().strip()
+        with open(f'{pack_base}-{pack_hash}.promisor', 'w'):
+            pass
+        await run_git(self.git_dir, 'prune-packed', '-q')
+        self.new_objects = []
+        self.obj_index.reload_packs()
+        self.obj_index.reload_loose()
+
+    def obj_info(self, obj_name: bytes) -> typing.Tuple[str, int]:
+        return self.reader.info(obj_name)
+
+    def read_obj_range(self, obj_name: bytes, start: int, size: int) -> bytes:
+        return self.reader.read(obj_name, start, size)
+
+    def read_loose_obj(self, obj_name: bytes) -> typing.Optional[bytes]:
+        return read_loose_obj(self.git_dir, obj_name)
+
+    def read_loose_range(self, obj_name: bytes, start: int, size: int) -> bytes:
+        return read_loose_range(self.git_dir, obj_name, start, size)
+
+    def loose_obj_crc32(self, obj_name: bytes) -> typing.Optional[typing.Tuple[int, int]]:
+        return loose_obj_crc32(self.git_dir, obj_name)
+
     def read_obj(self, obj_name: bytes) -> typing.Tuple[str, bytes]:
         ostream = self.repo.odb.stream(obj_name)
         return ostream.type.decode(), ostream.read()
@@ -33,6 +86,46 @@ class GitRepo:
         ref = Reference.create(self.repo, ref_name, head.hex(), force=True)
         return ref
 
+    def read_shallow(self) -> typing.Set[bytes]:
+        try:
+            with open(os.path.join(self.git_dir, 'shallow'), 'r') as f:
+                return {bytes.fromhex(ln.strip()) for ln in f if ln.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def write_shallow(self, shallow: typing.Set[bytes]):
+        path = os.path.join(self.git_dir, 'shallow')
+        if not shallow:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        fd, tmp_path = tempfile.mkstemp(prefix='tmp_shallow_', dir=self.git_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join(f'{name.hex()}\n' for name in sorted(shallow)))
+        os.replace(tmp_path, path)
+
+    def parse_date(self, date: str) -> int:
+        # Throws: GitCommandError, ValueError
+        max_age = self.repo.git.rev_parse(f'--since={date}')
+        return int(max_age.split('=')[1])
+
+
+def parse_filter(spec: str) -> typing.Optional[int]:
+    # Returns the blob size limit of a filter spec, -1 for blob:none
+    if spec == 'blob:none':
+        return -1
+    if spec.startswith('blob:limit='):
+        value = spec[len('blob:limit='):].lower()
+        unit = 1
+        if value and value[-1] in 'kmg':
+            unit = 1024 ** ('kmg'.index(value[-1]) + 1)
+            value = value[:-1]
+        try:
+            return int(value) * unit
+        except ValueError:
+            return None
+    return None
+
 
 def print_out(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
@@ -58,7 +151,7 @@ def parse_push(arg: str, local_repo_path: str) -> typing.Tuple[str, str, bool]:
 
 
 async def after_start(app: NDNApp, repo_prefix: str, repo_name: str, git_repo: GitRepo, local_repo_path: str):
-    options = {'cloning': False}
+    options = {'cloning': False, 'depth': None, 'since': None, 'blob_limit': None}
     handlers = {}
     running = True
     empty_cnt = 0
@@ -86,6 +179,23 @@ async def after_start(app: NDNApp, repo_prefix: str, repo_name: str, git_repo: G
         if opt_name == "cloning":
             options['cloning'] = (opt_val == 'true')
             print("ok")
+        elif opt_name == "depth":
+            try:
+                options['depth'] = int(opt_val)
+            except ValueError:
+                print(f"error invalid depth {opt_val}")
+                return
+            print("ok")
+        elif opt_name == "deepen-since":
+            try:
+                options['since'] = git_repo.parse_date(opt_val)
+            except (GitCommandError, ValueError, IndexError):
+                print(f"error invalid date {opt_val}")
+                return
+            print("ok")
+        elif opt_name == "filter":
+            options['blob_limit'] = parse_filter(opt_val)
+            print("ok" if options['blob_limit'] is not None else "unsupported")
         else:
             print("unsupported")
 
@@ -112,24 +222,48 @@ async def after_start(app: NDNApp, repo_prefix: str, repo_name: str, git_repo: G
     @CommandHandler()
     async def fetch(args):
         nonlocal fetcher, running, cmd
+        # Batched commands
+        fetch_list = []
         while True:
             hash_name, ref_name = args
+            fetch_list.append((hash_name, ref_name))
+            cmd = sys.stdin.readline().rstrip("\n\r")
+            if not cmd.startswith("fetch"):
+                break
+            args = cmd.split()[1:]
+        # A clone fetches everything in one pack, unless only part of it is wanted
+        partial = options['depth'] is not None or options['since'] is not None or options['blob_limit'] is not None
+        if options['cloning'] and not partial:
+            try:
+                await pack_fetcher.fetch([bytes.fromhex(hash_name) for hash_name, _ in fetch_list], [],
+                                         retry_times=CLONE_RETRY_TIMES)
+            except (ValueError, IndexError, DecodeError, GitCommandError,
+                    InterestCanceled, InterestTimeout, InterestNack, ValidationFailure) as e:
+                print_out(f"warning: Failed to fetch pack for {type(e)}, fetching objects instead")
+        for hash_name, ref_name in fetch_list:
             new_head = bytes.fromhex(hash_name)
+            # Objects wanted by a partial clone are named by their hash, and can be of any type
+            by_hash = ref_name == hash_name
             # Fetch files
             try:
-                await fetcher.fetch('commit', new_head)
+                await fetcher.fetch('' if by_hash else 'commit', new_head, depth=options['depth'],
+                                    since=options['since'], blob_limit=options['blob_limit'])
             except (ValueError, InterestCanceled, InterestTimeout, InterestNack, ValidationFailure) as e:
                 print_out(f"error: Failed to fetch commit {hash_name} for {type(e)}")
                 running = False
-                return
-            # Set refs file
-            git_repo.set_head(ref_name, new_head)
-            # Batched commands
-            cmd = sys.stdin.readline().rstrip("\n\r")
-            if not cmd.startswith("fetch"):
                 break
-            args = cmd.split()[1:]
-        print("")
+            # Set refs file
+            if not by_hash:
+                git_repo.set_head(ref_name, new_head)
+        git_repo.write_shallow(fetcher.shallow)
+        if options['blob_limit'] is not None:
+            try:
+                await git_repo.write_promisor_pack()
+            except GitCommandError as e:
+                print_out(f"error: Failed to write promisor pack for {e}")
+                running = False
+        if running:
+            print("")
 
     @CommandHandler()
     async def push(args):
@@ -180,7 +314,10 @@ async def after_start(app: NDNApp, repo_prefix: str, repo_name: str, git_repo: G
 
     # after_start
     try:
-        fetcher = ObjectFetcher(app, git_repo, Name.from_str(repo_prefix + '/objects'))
+        signer = object_signer()
+        fetcher = ObjectFetcher(app, git_repo, Name.from_str(repo_prefix + '/objects'), signer=signer)
+        fetcher.shallow = git_repo.read_shallow()
+        pack_fetcher = PackFetcher(app, git_repo, Name.from_str(repo_prefix + '/pack'), signer=signer)
         while empty_cnt < 2 and running:
             cmd = sys.stdin.readline().rstrip("\n\r")
             if cmd == '':
@@ -1,5 +1,8 @@
 import os
+import typing
 import logging
+import hashlib
+import tempfile
 import ndn.encoding as enc
 from Cryptodome.PublicKey import ECC, RSA
 from Cryptodome.Signature import DSS, pkcs1_15
@@ -7,6 +10,76 @@ from Cryptodome.Hash import SHA256
 from .. import repos
 
 
+VERIFIED_FILE = 'ndn-verified-signatures'
+
+
+class KeyState(typing.NamedTuple):
+    head: bytes
+    cert_sha: bytes
+    verifier: typing.Any
+    revoked: bool
+
+
+class VerifiedSignatures:
+    # Blobs whose signature has been verified, with the signer and the certificate used.
+    # Blobs are immutable, so a result holds as long as the certificate is the same.
+    # "<blob-sha> <cert-sha> <key-id> <uid>" per line, appended as results come.
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = None
+        self.file = None
+
+    def load(self) -> typing.Dict[bytes, typing.Tuple[str, str, bytes]]:
+        if self.entries is not None:
+            return self.entries
+        self.entries = {}
+        lines = 0
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    lines += 1
+                    try:
+                        blob_hex, cert_hex, key_name, user_name = line[:-1].split(' ', 3)
+                        self.entries[bytes.fromhex(blob_hex)] = (user_name, key_name, bytes.fromhex(cert_hex))
+                    except ValueError:
+                        logging.warning(f'Invalid line in {self.path}')
+        except FileNotFoundError:
+            pass
+        if lines > len(self.entries):
+            self.compact()
+        return self.entries
+
+    def get(self, blob_sha: bytes) -> typing.Optional[typing.Tuple[str, str, bytes]]:
+        return self.load().get(blob_sha)
+
+    def add(self, blob_sha: bytes, user_name: str, key_name: str, cert_sha: bytes):
+        self.load()[blob_sha] = (user_name, key_name, cert_sha)
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(f'{blob_sha.hex()} {cert_sha.hex()} {key_name} {user_name}\n')
+        self.file.flush()
+
+    def discard(self, blob_sha: bytes):
+        # Dropped from memory only; the line on disk is checked again after a restart
+        self.load().pop(blob_sha, None)
+
+    def compact(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        fd, tmp_path = tempfile.mkstemp(prefix='tmp_verified_', dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join(f'{blob_sha.hex()} {cert_sha.hex()} {key_name} {user_name}\n'
+                                for blob_sha, (user_name, key_name, cert_sha) in self.entries.items()))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
 class Accounts:
     repos: repos.GitRepos
 
@@ -14,6 +87,10 @@ class Accounts:
         self.repo = git_repos['All-Users.git']
         self.trust_anchor_verifier = None
         self.trust_anchor_name = None
+        self.trust_anchor_sha = None
+        # (uid, key-id) -> key of the user at a head of the user branch
+        self.key_states = {}
+        self.verified = VerifiedSignatures(os.path.join(self.repo.git_dir, VERIFIED_FILE))
 
     def read_trust_anchor(self):
         ta_path = os.path.abspath(os.getenv('GIT_NDN_TRUST_ANCHOR'))
@@ -23,11 +100,12 @@ class Accounts:
         user_name = bytes(enc.Component.get_value(ta_name[-5])).decode()
         key_name = bytes(enc.Component.get_value(ta_name[-3])).hex()
         self.trust_anchor_name = (user_name, key_name)
+        self.trust_anchor_sha = hashlib.sha1(cert).digest()
         pub_key = ECC.import_key(bytes(key_bits))
         self.trust_anchor_verifier = DSS.new(pub_key, 'fips-186-3', 'der')
         logging.info(f'Trust anchor loaded: {enc.Name.to_str(ta_name)}')
 
-    def verify(self, sig_ptrs: enc.SignaturePtrs) -> bool:
+    def verify(self, sig_ptrs: enc.SignaturePtrs, blob_sha: typing.Optional[bytes] = None) -> bool:
         if (sig_ptrs.signature_info is None
                 or sig_ptrs.signature_info.key_locator is None
                 or sig_ptrs.signature_info.key_locator.name is None):
@@ -38,25 +116,13 @@ class Accounts:
 
         if (user_name, key_name) == self.trust_anchor_name:
             verifier = self.trust_anchor_verifier
+            cert_sha = self.trust_anchor_sha
+            revoked = False
         else:
-            try:
-                cert = self.repo.read_file(f'refs/users/{user_name[:2]}/{user_name}', f'KEY/{key_name}.cert')
-            except KeyError as e:
-                if e.args[0] == 0:
-                    logging.warning(f'Repo {e.args[1]} does not exist')
-                if e.args[0] == 1:
-                    logging.warning(f'User {user_name} does not exist')
-                elif e.args[0] == 2:
-                    logging.warning(f'Certificate {user_name}/KEY/{key_name}.cert does not exist')
-                return False
-
-            try:
-                _, _, key_bits, _ = enc.parse_data(cert, with_tl=True)
-                pub_key = ECC.import_key(bytes(key_bits))
-                verifier = DSS.new(pub_key, 'fips-186-3', 'der')
-            except (ValueError, IndexError, KeyError):
-                logging.warning(f'Certificate {user_name}/KEY/{key_name}.cert is malformed')
+            state = self.key_state(user_name, key_name)
+            if state is None:
                 return False
+            verifier, cert_sha, revoked = state.verifier, state.cert_sha, state.revoked
 
         h = SHA256.new()
         for content in sig_ptrs.signature_covered_part:
@@ -67,4 +133,61 @@ class Accounts:
             logging.info(f'Unable to verify the signature: signed by {user_name}/KEY/{key_name}')
             return False
         logging.debug(f'Verification passed')
+        # Results of a revoked key are not kept, so that its signatures are always checked again
+        if blob_sha is not None and not revoked:
+            self.verified.add(blob_sha, user_name, key_name, cert_sha)
         return True
+
+    def is_verified(self, blob_sha: bytes) -> bool:
+        # Whether the blob was verified with a certificate that is still in All-Users and not revoked
+        entry = self.verified.get(blob_sha)
+        if entry is None:
+            return False
+        user_name, key_name, cert_sha = entry
+        if (user_name, key_name) == self.trust_anchor_name:
+            valid = cert_sha == self.trust_anchor_sha
+        else:
+            state = self.key_state(user_name, key_name)
+            valid = state is not None and not state.revoked and state.cert_sha == cert_sha
+        if not valid:
+            self.verified.discard(blob_sha)
+        return valid
+
+    def key_state(self, user_name: str, key_name: str) -> typing.Optional[KeyState]:
+        ref_name = f'refs/users/{user_name[:2]}/{user_name}'
+        try:
+            head = self.repo.get_head(ref_name)
+        except KeyError as e:
+            if e.args[0] == 0:
+                logging.warning(f'Repo {e.args[1]} does not exist')
+            elif e.args[0] == 1:
+                logging.warning(f'User {user_name} does not exist')
+            return None
+        state = self.key_states.get((user_name, key_name))
+        if state is not None and state.head == head:
+            return state
+        tree = self.repo.get_commit(head).tree
+        try:
+            cert_file = tree[f'KEY/{key_name}.cert']
+        except KeyError:
+            logging.warning(f'Certificate {user_name}/KEY/{key_name}.cert does not exist')
+            self.key_states.pop((user_name, key_name), None)
+            return None
+        try:
+            tree[f'KEY/{key_name}.revoke.tlv']
+            revoked = True
+        except KeyError:
+            revoked = False
+        if state is not None and state.cert_sha == cert_file.binsha:
+            verifier = state.verifier
+        else:
+            try:
+                _, _, key_bits, _ = enc.parse_data(cert_file.data_stream.read(), with_tl=True)
+                pub_key = ECC.import_key(bytes(key_bits))
+                verifier = DSS.new(pub_key, 'fips-186-3', 'der')
+            except (ValueError, IndexError, KeyError):
+                logging.warning(f'Certificate {user_name}/KEY/{key_name}.cert is malformed')
+                return None
+        state = KeyState(head, cert_file.binsha, verifier, revoked)
+        self.key_states[(user_name, key_name)] = state
+        return state
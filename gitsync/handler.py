@@ -62,7 +62,8 @@ class Handler:
             return False
         # Force update
         if force:
-            self.repo.set_head(ref_name, ref_head)
+            async with self.pipeline.ref_lock(ref_name):
+                self.repo.set_head(ref_name, ref_head)
         else:
             await self.pipeline.after_update({ref_name: ref_head}, None)
         return True
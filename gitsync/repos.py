@@ -1,12 +1,582 @@
 import os
 import io
+import sys
+import zlib
+import heapq
+import collections
+import struct
+import logging
 import typing
-from git import Repo, Reference, Commit
+import tempfile
+import asyncio as aio
+from git import Repo, Reference, Commit, Tree, Blob, GitCommandError
+from gitdb import GitDB
 from gitdb.base import IStream
+from gitdb.exc import BadObject
 from .db import proto
+from .sync.cache import LruCache
 from ndn import encoding as enc
 
 
+OBJ_INFO_CACHE_SIZE = 65536
+OPEN_STREAM_COUNT = 16
+STREAM_CHUNK_SIZE = 65536
+PACK_INDEX_MAGIC = b'\xfftOc'
+PACKED_REFS_HEADER = '# pack-refs with: peeled fully-peeled sorted \n'
+
+
+class ObjectStream:
+    # An object stream inflated once. Inflated bytes are spilled to a temporary file,
+    # so that reading backwards, e.g. for retransmissions or interleaved consumers, does not inflate again.
+    def __init__(self, db: GitDB, obj_name: bytes):
+        self.db = db
+        self.obj_name = obj_name
+        self.ostream = None
+        self.spill = None
+        self.pos = 0
+
+    def read_at(self, start: int, size: int) -> bytes:
+        if self.ostream is None:
+            self.ostream = self.db.stream(self.obj_name)
+            self.spill = tempfile.TemporaryFile()
+        end = start + size
+        while self.pos < end:
+            chunk = self.ostream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            self.spill.seek(self.pos)
+            self.spill.write(chunk)
+            self.pos += len(chunk)
+        if start >= self.pos:
+            return b''
+        self.spill.seek(start)
+        return self.spill.read(min(end, self.pos) - start)
+
+
+class ObjectReader:
+    # Reads parts of objects in bounded memory, using memory-mapped loose objects and packs.
+    # Note: deltified objects in packs are still resolved in memory by gitdb.
+    # Git does not deltify objects larger than core.bigFileThreshold.
+    def __init__(self, objects_dir: str):
+        self.db = GitDB(objects_dir)
+        self.infos = LruCache(OBJ_INFO_CACHE_SIZE, size_of=lambda _: 1)
+        self.streams = LruCache(OPEN_STREAM_COUNT, size_of=lambda _: 1)
+
+    def _retry(self, func, obj_name: bytes):
+        # Throws: ValueError
+        try:
+            return func(obj_name)
+        except BadObject:
+            # A new pack may have been added
+            self.db.update_cache(force=True)
+        try:
+            return func(obj_name)
+        except BadObject:
+            raise ValueError(f'Object {obj_name.hex()} does not exist')
+
+    def info(self, obj_name: bytes) -> typing.Tuple[str, int]:
+        ret = self.infos.get(obj_name)
+        if ret is None:
+            oinfo = self._retry(self.db.info, obj_name)
+            ret = (oinfo.type.decode(), oinfo.size)
+            self.infos.put(obj_name, ret)
+        return ret
+
+    def read(self, obj_name: bytes, start: int, size: int) -> bytes:
+        stream = self.streams.get(obj_name)
+        if stream is None:
+            self._retry(self.db.info, obj_name)
+            stream = ObjectStream(self.db, obj_name)
+            self.streams.put(obj_name, stream)
+        return stream.read_at(start, size)
+
+    def read_small(self, obj_name: bytes) -> bytes:
+        # Small objects such as commits are read at once, without a stream kept for range reads
+        return self._retry(self.db.stream, obj_name).read()
+
+
+class CommitGraph:
+    # In-memory parents and generation numbers of commits, to answer ancestry without running git.
+    # Commits are loaded on first use, or added by the fetcher as they arrive.
+    # Missing parents, e.g. beyond a shallow boundary or not fetched yet, are treated as absent.
+    def __init__(self, reader: ObjectReader):
+        self.reader = reader
+        self.parents = {}
+        # Generations of commits whose whole history is present
+        self.generations = {}
+        # Generations counting missing commits as 0, valid until one of the missing commits is stored
+        self.partial = {}
+        self.missing = set()
+
+    @staticmethod
+    def parse_parents(content: bytes) -> typing.Tuple[bytes, ...]:
+        ret = []
+        for line in content.split(b'\n'):
+            if not line:
+                break
+            if line.startswith(b'parent '):
+                ret.append(bytes.fromhex(line[7:47].decode()))
+        return tuple(ret)
+
+    def add(self, obj_name: bytes, content: bytes):
+        if obj_name not in self.parents:
+            self.parents[obj_name] = self.parse_parents(content)
+        if obj_name in self.missing:
+            self.forget_partial()
+
+    def refresh(self):
+        # Missing commits may have been stored without add(), e.g. from a pack
+        if any(self.get_parents(commit) is not None for commit in self.missing):
+            self.forget_partial()
+
+    def forget_partial(self):
+        self.partial.clear()
+        self.missing.clear()
+
+    def get_parents(self, obj_name: bytes) -> typing.Optional[typing.Tuple[bytes, ...]]:
+        ret = self.parents.get(obj_name)
+        if ret is None:
+            try:
+                obj_type, _ = self.reader.info(obj_name)
+                if obj_type != 'commit':
+                    return None
+                ret = self.parse_parents(self.reader.read_small(obj_name))
+            except ValueError:
+                return None
+            self.parents[obj_name] = ret
+        return ret
+
+    def known_generation(self, obj_name: bytes) -> typing.Optional[int]:
+        ret = self.generations.get(obj_name)
+        return ret if ret is not None else self.partial.get(obj_name)
+
+    def generation(self, obj_name: bytes) -> int:
+        # 1 for a root commit, 0 for a missing one
+        ret = self.known_generation(obj_name)
+        if ret is not None:
+            return ret
+        stack = [obj_name]
+        while stack:
+            top = stack[-1]
+            if self.known_generation(top) is not None:
+                stack.pop()
+                continue
+            parents = self.get_parents(top)
+            if parents is None:
+                self.missing.add(top)
+                self.partial[top] = 0
+                stack.pop()
+                continue
+            pending = [p for p in parents if self.known_generation(p) is None]
+            if pending:
+                stack.extend(pending)
+            else:
+                gen = 1 + max((self.known_generation(p) for p in parents), default=0)
+                if all(p in self.generations for p in parents):
+                    self.generations[top] = gen
+                else:
+                    self.partial[top] = gen
+                stack.pop()
+        return self.known_generation(obj_name)
+
+    def is_ancestor(self, ancestor: bytes, head: bytes) -> bool:
+        # Commits below the generation of ancestor cannot reach it
+        min_gen = self.generation(ancestor)
+        if min_gen == 0:
+            return False
+        stack = [head]
+        seen = {head}
+        while stack:
+            commit = stack.pop()
+            if commit == ancestor:
+                return True
+            for parent in self.get_parents(commit) or ():
+                if parent not in seen and self.generation(parent) >= min_gen:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+    def paint(self, heads: typing.Dict[bytes, int], done: typing.Callable[[typing.Counter[int]], bool],
+              stop_flag: int = 0) -> typing.Iterator[typing.Tuple[bytes, int]]:
+        # Walk down from heads, marking each commit with the union of the flags of the heads reaching it.
+        # Commits are visited in decreasing generation, so the flags of a commit are final when it is visited.
+        # The walk ends when done(queued) holds, queued counting the commits in the queue by flags,
+        # and does not go below commits whose flags are stop_flag.
+        flags = dict(heads)
+        queued = collections.Counter(heads.values())
+        queue = [(-self.generation(head), head) for head in heads]
+        heapq.heapify(queue)
+        while queue and not done(queued):
+            _, commit = heapq.heappop(queue)
+            flag = flags[commit]
+            queued[flag] -= 1
+            yield commit, flag
+            if flag == stop_flag:
+                continue
+            for parent in self.get_parents(commit) or ():
+                if self.generation(parent) == 0:
+                    continue
+                if parent not in flags:
+                    flags[parent] = flag
+                    queued[flag] += 1
+                    heapq.heappush(queue, (-self.generation(parent), parent))
+                elif flags[parent] | flag != flags[parent]:
+                    # A parent has a lower generation, so it is still in the queue
+                    queued[flags[parent]] -= 1
+                    flags[parent] |= flag
+                    queued[flags[parent]] += 1
+
+    def merge_bases(self, head1: bytes, head2: bytes) -> typing.List[bytes]:
+        # Best common ancestors: common ancestors which are not ancestors of other common ones.
+        # Once one side has nothing left in the queue, no more commits can become common,
+        # but the common ones in the queue are still collected.
+        if head1 == head2:
+            return [head1]
+        walk = self.paint({head1: 1, head2: 2},
+                          lambda queued: not queued[3] and (not queued[1] or not queued[2]),
+                          stop_flag=3)
+        candidates = [commit for commit, flag in walk if flag == 3]
+        return [commit for commit in candidates
+                if not any(other != commit and self.is_ancestor(commit, other) for other in candidates)]
+
+    def list_commits(self, ancestor: typing.Optional[bytes], head: bytes) -> typing.List[bytes]:
+        # Same as git rev-list --topo-order ancestor..head, but parents first
+        heads = {head: 1}
+        if ancestor:
+            heads[ancestor] = heads.get(ancestor, 0) | 2
+        ret = [commit for commit, flag in self.paint(heads, lambda queued: not queued[1]) if flag == 1]
+        ret.reverse()
+        return ret
+
+
+def read_pack_index(path: str) -> typing.List[bytes]:
+    # Object names in a pack index file of version 1 or 2
+    with open(path, 'rb') as f:
+        content = f.read()
+    if content[:4] == PACK_INDEX_MAGIC:
+        version, = struct.unpack_from('>I', content, 4)
+        if version != 2:
+            raise ValueError(f'Unsupported pack index version {version}')
+        count, = struct.unpack_from('>I', content, 8 + 255 * 4)
+        start = 8 + 256 * 4
+        return [content[start + i * 20:start + i * 20 + 20] for i in range(count)]
+    else:
+        count, = struct.unpack_from('>I', content, 255 * 4)
+        start = 256 * 4
+        return [content[start + i * 24 + 4:start + i * 24 + 24] for i in range(count)]
+
+
+class ObjectIndex:
+    # In-memory index of the objects in a repo, checked before asking the object database.
+    # Packed objects are kept in a sorted array loaded from the pack indexes,
+    # loose objects and objects stored since then are kept in a set.
+    def __init__(self, objects_dir: str):
+        self.objects_dir = objects_dir
+        self.packed = b''
+        self.fanout = [0] * 257
+        self.pack_files = []
+        self.loose = set()
+        self.lookups = 0
+        self.hits = 0
+        self.stale_misses = 0
+        self.false_positives = 0
+        self.reload_packs()
+        self.reload_loose()
+        logging.info(f'Loaded object index of {len(self)} entries from {objects_dir}')
+
+    def __len__(self):
+        return len(self.packed) // 20 + len(self.loose)
+
+    def __contains__(self, obj_name: bytes) -> bool:
+        self.lookups += 1
+        if obj_name in self.loose or self.search_packed(obj_name):
+            self.hits += 1
+            return True
+        return False
+
+    def search_packed(self, obj_name: bytes) -> bool:
+        lo = self.fanout[obj_name[0]]
+        hi = self.fanout[obj_name[0] + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self.packed[mid * 20:mid * 20 + 20]
+            if entry < obj_name:
+                lo = mid + 1
+            elif entry > obj_name:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def reload_packs(self):
+        pack_dir = os.path.join(self.objects_dir, 'pack')
+        if os.path.isdir(pack_dir):
+            pack_files = sorted(f for f in os.listdir(pack_dir) if f.endswith('.idx'))
+        else:
+            pack_files = []
+        if pack_files == self.pack_files:
+            return
+        names = set()
+        for f in pack_files:
+            names.update(read_pack_index(os.path.join(pack_dir, f)))
+        names = sorted(names)
+        self.packed = b''.join(names)
+        self.fanout = [0] * 257
+        for name in names:
+            self.fanout[name[0] + 1] += 1
+        for i in range(256):
+            self.fanout[i + 1] += self.fanout[i]
+        self.pack_files = pack_files
+
+    def reload_loose(self):
+        self.loose = set()
+        for d in os.listdir(self.objects_dir):
+            if len(d) != 2:
+                continue
+            for f in os.listdir(os.path.join(self.objects_dir, d)):
+                if len(f) == 38:
+                    try:
+                        self.loose.add(bytes.fromhex(d + f))
+                    except ValueError:
+                        pass
+
+    def add(self, obj_name: bytes):
+        self.loose.add(obj_name)
+
+    def add_stale(self, obj_name: bytes):
+        # Found in the object database but not in the index, e.g. written by another process
+        self.stale_misses += 1
+        self.add(obj_name)
+
+    def discard(self, obj_name: bytes):
+        # Found in the index but not in the object database, e.g. pruned by git gc
+        self.false_positives += 1
+        self.loose.discard(obj_name)
+        self.pack_files = None
+        self.reload_packs()
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'entries': len(self),
+            'memory_bytes': (sys.getsizeof(self.packed) + sys.getsizeof(self.loose)
+                             + len(self.loose) * sys.getsizeof(b'\x00' * 20)),
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'stale_misses': self.stale_misses,
+            'false_positives': self.false_positives,
+        }
+
+
+def loose_obj_path(git_dir: str, obj_name: bytes) -> str:
+    hex_name = obj_name.hex()
+    return os.path.join(git_dir, 'objects', hex_name[:2], hex_name[2:])
+
+
+def read_loose_obj(git_dir: str, obj_name: bytes) -> typing.Optional[bytes]:
+    try:
+        with open(loose_obj_path(git_dir, obj_name), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def read_loose_range(git_dir: str, obj_name: bytes, start: int, size: int) -> bytes:
+    with open(loose_obj_path(git_dir, obj_name), 'rb') as f:
+        f.seek(start)
+        return f.read(size)
+
+
+def loose_obj_crc32(git_dir: str, obj_name: bytes) -> typing.Optional[typing.Tuple[int, int]]:
+    # Returns the size and CRC-32 of a loose object file, reading it in chunks
+    crc = 0
+    size = 0
+    try:
+        with open(loose_obj_path(git_dir, obj_name), 'rb') as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+    except FileNotFoundError:
+        return None
+    return size, crc
+
+
+class LooseObjectWriter:
+    # Writes a loose object chunk by chunk into a temporary file, which is renamed once the name is verified
+    def __init__(self, git_dir: str, on_commit: typing.Optional[typing.Callable[[bytes], None]] = None):
+        self.git_dir = git_dir
+        self.on_commit = on_commit
+        fd, self.tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir=os.path.join(git_dir, 'objects'))
+        self.file = os.fdopen(fd, 'wb')
+        self.compressor = None
+
+    def write_compressed(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def write_raw(self, chunk: bytes):
+        # Raw chunks must include the object header
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(zlib.Z_BEST_SPEED)
+        self.file.write(self.compressor.compress(chunk))
+
+    def commit(self, obj_name: bytes):
+        # The caller is responsible for verifying the content
+        try:
+            if self.compressor is not None:
+                self.file.write(self.compressor.flush())
+            self.file.close()
+            path = loose_obj_path(self.git_dir, obj_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(self.tmp_path, 0o444)
+            os.replace(self.tmp_path, path)
+        except BaseException:
+            self.abort()
+            raise
+        if self.on_commit is not None:
+            self.on_commit(obj_name)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+async def start_git(git_dir: str, *args: str) -> aio.subprocess.Process:
+    return await aio.create_subprocess_exec('git', f'--git-dir={git_dir}', *args,
+                                            stdin=aio.subprocess.PIPE,
+                                            stdout=aio.subprocess.PIPE,
+                                            stderr=aio.subprocess.PIPE)
+
+
+async def run_git(git_dir: str, *args: str, input: typing.Optional[bytes] = None) -> bytes:
+    # Unlike GitPython's commands, this does not block the event loop
+    proc = await start_git(git_dir, *args)
+    stdout, stderr = await proc.communicate(input)
+    if proc.returncode != 0:
+        raise GitCommandError(['git', *args], proc.returncode, stderr)
+    return stdout
+
+
+def diff_trees(old: typing.Optional[Tree], new: typing.Optional[Tree]) \
+        -> typing.Iterator[typing.Tuple[str, typing.Optional[Blob], typing.Optional[Blob]]]:
+    # Blobs added, modified or deleted from old to new, as (path, old blob, new blob).
+    # Subtrees with the same SHA are skipped, so the work follows the size of the change.
+    old_items = {item.name: item for item in old} if old is not None else {}
+    new_items = {item.name: item for item in new} if new is not None else {}
+    for name in sorted(old_items.keys() | new_items.keys()):
+        old_item = old_items.get(name)
+        new_item = new_items.get(name)
+        if old_item is not None and new_item is not None and old_item.binsha == new_item.binsha:
+            continue
+        old_tree = old_item if old_item is not None and old_item.type == 'tree' else None
+        new_tree = new_item if new_item is not None and new_item.type == 'tree' else None
+        if old_tree is not None or new_tree is not None:
+            yield from diff_trees(old_tree, new_tree)
+        old_blob = old_item if old_item is not None and old_item.type == 'blob' else None
+        new_blob = new_item if new_item is not None and new_item.type == 'blob' else None
+        if old_blob is not None or new_blob is not None:
+            yield (new_blob or old_blob).path, old_blob, new_blob
+
+
+def write_packed_refs(git_dir: str, updates: typing.Dict[str, typing.Optional[bytes]]):
+    # Apply ref updates (None to delete) with one rewrite of packed-refs, under the lock file git uses.
+    # Loose refs of the same names are removed afterwards, since they take precedence.
+    # Throws: FileExistsError if packed-refs is locked
+    path = os.path.join(git_dir, 'packed-refs')
+    lock_path = path + '.lock'
+    fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        header = PACKED_REFS_HEADER
+        refs = {}
+        last = None
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.startswith('#'):
+                        header = line
+                    elif line.startswith('^'):
+                        # Peeled value of the tag above
+                        if last is not None:
+                            refs[last].append(line)
+                    else:
+                        last = line.rstrip('\n').partition(' ')[2]
+                        refs[last] = [line]
+        except FileNotFoundError:
+            pass
+        for ref_name, head in updates.items():
+            if head is None:
+                refs.pop(ref_name, None)
+            else:
+                refs[ref_name] = [f'{head.hex()} {ref_name}\n']
+        with os.fdopen(fd, 'w') as f:
+            fd = None
+            f.write(header + ''.join(''.join(refs[ref_name]) for ref_name in sorted(refs)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(lock_path, path)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        os.unlink(lock_path)
+        raise
+    for ref_name in updates:
+        try:
+            os.unlink(os.path.join(git_dir, *ref_name.split('/')))
+        except FileNotFoundError:
+            pass
+
+
+class RefTransaction:
+    # Ref updates staged in the in-memory ref table and written together by commit().
+    # Staged heads are visible through get_head right away, e.g. for certificates added by a commit.
+    # Since abort() restores the heads it replaced, other writers of the same refs must be kept out
+    # while it is open, e.g. by the ref locks of the sync pipeline.
+    def __init__(self, repo: 'GitRepo'):
+        self.repo = repo
+        self.heads = repo._ref_heads()
+        # Ref name -> head before the transaction, None if it did not exist
+        self.original = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def set_head(self, ref_name: str, head: bytes):
+        if ref_name not in self.original:
+            self.original[ref_name] = self.heads.get(ref_name)
+        self.heads[ref_name] = head
+
+    def del_ref(self, ref_name: str):
+        if ref_name not in self.original:
+            self.original[ref_name] = self.heads.get(ref_name)
+        self.heads.pop(ref_name, None)
+
+    def commit(self):
+        updates = {ref_name: self.heads.get(ref_name) for ref_name in self.original
+                   if self.heads.get(ref_name) != self.original[ref_name]}
+        if updates:
+            try:
+                write_packed_refs(self.repo.git_dir, updates)
+            except BaseException:
+                self.abort()
+                raise
+        self.original = {}
+
+    def abort(self):
+        for ref_name, head in self.original.items():
+            if head is None:
+                self.heads.pop(ref_name, None)
+            else:
+                self.heads[ref_name] = head
+        self.original = {}
+
+
 class GitRepos:
     base_dir: str
     repos: typing.Dict[str, Repo]  # Note: memory leak, refer to doc
@@ -24,6 +594,11 @@ class GitRepos:
                 for f in os.listdir(base_dir)
                 if os.path.isdir(os.path.join(base_dir, f))
             }
+        self.readers = {}
+        self.indexes = {}
+        # Ref name -> head of each repo, loaded on first use and kept by set_head and del_ref
+        self.ref_heads = {}
+        self.graphs = {}
 
     def __getitem__(self, item):
         if item not in self.repos:
@@ -114,6 +689,10 @@ class GitRepo:
         except KeyError:
             raise KeyError(0, self.repo_name)  # Note: Use enum
 
+    @property
+    def git_dir(self) -> str:
+        return self._get_repo().git_dir
+
     def _get_ref(self, ref_name: str) -> Reference:
         repo = self._get_repo()
         user_ref = None
@@ -136,65 +715,140 @@ class GitRepo:
 
         return file.data_stream.read()
 
-    # This does not work for big object
+    # This does not work for big object, use read_obj_range instead
     def read_obj(self, obj_name: bytes) -> typing.Tuple[str, bytes]:
         # Throws: KeyError, ValueError
         repo = self._get_repo()
         ostream = repo.odb.stream(obj_name)
         return ostream.type.decode(), ostream.read()
 
+    @property
+    def reader(self) -> ObjectReader:
+        if self.repo_name not in self.repos.readers:
+            self.repos.readers[self.repo_name] = ObjectReader(os.path.join(self.git_dir, 'objects'))
+        return self.repos.readers[self.repo_name]
+
+    def obj_info(self, obj_name: bytes) -> typing.Tuple[str, int]:
+        # Throws: ValueError
+        return self.reader.info(obj_name)
+
+    def read_obj_range(self, obj_name: bytes, start: int, size: int) -> bytes:
+        # Throws: ValueError
+        return self.reader.read(obj_name, start, size)
+
+    def read_loose_obj(self, obj_name: bytes) -> typing.Optional[bytes]:
+        return read_loose_obj(self.git_dir, obj_name)
+
+    def read_loose_range(self, obj_name: bytes, start: int, size: int) -> bytes:
+        return read_loose_range(self.git_dir, obj_name, start, size)
+
+    def loose_obj_crc32(self, obj_name: bytes) -> typing.Optional[typing.Tuple[int, int]]:
+        return loose_obj_crc32(self.git_dir, obj_name)
+
+    @property
+    def obj_index(self) -> ObjectIndex:
+        if self.repo_name not in self.repos.indexes:
+            self.repos.indexes[self.repo_name] = ObjectIndex(os.path.join(self.git_dir, 'objects'))
+        return self.repos.indexes[self.repo_name]
+
     def has_obj(self, obj_name: bytes) -> bool:
+        if obj_name in self.obj_index:
+            return True
         repo = self._get_repo()
-        return repo.odb.has_object(obj_name)
+        if repo.odb.has_object(obj_name):
+            self.obj_index.add_stale(obj_name)
+            return True
+        return False
 
     def store_obj(self, obj_type: bytes, data: bytes) -> bytes:
         repo = self._get_repo()
         istream = IStream(obj_type, len(data), io.BytesIO(data))
         repo.odb.store(istream)
+        self.obj_index.add(istream.binsha)
         return istream.binsha
 
+    def open_writer(self) -> LooseObjectWriter:
+        return LooseObjectWriter(self.git_dir, self.obj_index.add)
+
+    async def pack_objects(self, wants: typing.List[bytes], haves: typing.List[bytes]) -> bytes:
+        # A thin pack containing everything reachable from wants but not from haves
+        revs = ''.join(f'{want.hex()}\n' for want in wants) + ''.join(f'^{have.hex()}\n' for have in haves)
+        return await run_git(self.git_dir, 'pack-objects', '--revs', '--stdout', '--thin',
+                             '--delta-base-offset', '-q', input=revs.encode())
+
+    def _ref_heads(self) -> typing.Dict[str, bytes]:
+        heads = self.repos.ref_heads.get(self.repo_name)
+        if heads is None:
+            repo = self._get_repo()
+            heads = {
+                ref.path: ref.commit.binsha
+                for ref in repo.refs
+            }
+            self.repos.ref_heads[self.repo_name] = heads
+        return heads
+
     def get_head(self, ref_name: str) -> bytes:
-        return self._get_ref(ref_name).commit.binsha
+        heads = self._ref_heads()
+        if ref_name not in heads:
+            raise KeyError(1, ref_name)
+        return heads[ref_name]
 
     def set_head(self, ref_name: str, head: bytes) -> Reference:
         repo = self._get_repo()
         ref = Reference.create(repo, ref_name, head.hex(), force=True)
+        heads = self.repos.ref_heads.get(self.repo_name)
+        if heads is not None:
+            heads[ref_name] = head
         return ref
 
     def del_ref(self, ref_name: str):
         repo = self._get_repo()
         # No exception will be thrown
         Reference.delete(repo, ref_name)
+        heads = self.repos.ref_heads.get(self.repo_name)
+        if heads is not None:
+            heads.pop(ref_name, None)
+
+    def ref_transaction(self) -> RefTransaction:
+        return RefTransaction(self)
+
+    @property
+    def commit_graph(self) -> CommitGraph:
+        if self.repo_name not in self.repos.graphs:
+            self.repos.graphs[self.repo_name] = CommitGraph(self.reader)
+        return self.repos.graphs[self.repo_name]
 
     def is_ancestor(self, ancestor: bytes, head: bytes):
-        return self._get_repo().is_ancestor(ancestor.hex(), head.hex())
+        # Throws: GitCommandError
+        graph = self.commit_graph
+        graph.refresh()
+        for commit in (ancestor, head):
+            if graph.generation(commit) == 0:
+                raise GitCommandError('merge-base', 128, f'Not a valid commit name {commit.hex()}')
+        return graph.is_ancestor(ancestor, head)
 
     def merge_base(self, head1: bytes, head2: bytes) -> Commit:
-        base_list = self._get_repo().merge_base(head1.hex(), head2.hex())
-        if len(base_list) != 1:
+        graph = self.commit_graph
+        graph.refresh()
+        base_list = graph.merge_bases(head1, head2)
+        if not base_list:
+            raise ValueError('No merge base')
+        elif len(base_list) != 1:
             raise ValueError('Multiple merge bases')
         else:
-            return base_list[0]
+            return self.get_commit(base_list[0])
 
     def list_commits(self, ancestor: bytes, head: bytes):
-        repo = self._get_repo()
-        if ancestor:
-            ret = list(repo.iter_commits(f'{ancestor.hex()}..{head.hex()}'))
-        else:
-            ret = list(repo.iter_commits(f'{head.hex()}'))
-        ret.reverse()
-        return ret
+        # Parents come before their children, which incremental checks rely on
+        graph = self.commit_graph
+        graph.refresh()
+        return [self.get_commit(commit) for commit in graph.list_commits(ancestor, head)]
 
     def get_commit(self, head: bytes) -> Commit:
         return Commit(self._get_repo(), head)
 
     def get_ref_heads(self) -> typing.Dict[str, bytes]:
-        repo = self._get_repo()
-        ret = {
-            ref.path: ref.commit.binsha
-            for ref in repo.refs
-        }
-        return ret
+        return dict(self._ref_heads())
 
     def create_init_commit(self, tree: typing.Dict[str, typing.Union[typing.Dict, bytes]]) -> bytes:
         def generate_tree(data) -> typing.Tuple[bytes, bytes]:
@@ -2,14 +2,18 @@ import os
 import typing
 import logging
 import dataclasses
+import asyncio as aio
 from ndn.app import NDNApp
 from ndn.encoding import Name, FormalName, InterestParam, BinaryStr
 from ndn.security import TpmFile
 from .repos import GitRepos
 from .account.account import Accounts
 from .sync.fetch_queue import ObjectFetcher
+from .sync.pack_fetch import PackFetcher
 from .sync.fetch_pipeline import RepoSyncPipeline
 from .sync.vsync import VSync
+from .sync.metrics import export_text
+from .sync.signing import object_signer
 from .sync import packet
 from .handler import Handler
 
@@ -19,6 +23,7 @@ class Server:
     class Repo:
         vsync: VSync
         fetcher: ObjectFetcher
+        pack_fetcher: PackFetcher
         pipeline: RepoSyncPipeline
         handler: Handler
 
@@ -26,6 +31,7 @@ class Server:
         self.app = app
         tpm = TpmFile(os.path.abspath(os.getenv('GIT_NDN_TPM')))
         self.signer = tpm.get_signer(os.getenv('GIT_NDN_KEY'))
+        self.object_signer = object_signer()
         repo_path = os.path.join(os.path.abspath(os.getenv('GIT_NDN_BASEDIR')), 'git')
         if not os.path.exists(repo_path):
             os.makedirs(repo_path)
@@ -42,20 +48,25 @@ class Server:
         await self.app.register(os.getenv("GIT_NDN_PREFIX") + '/create-project', self.create_project)
         await self.app.register(os.getenv("GIT_NDN_PREFIX") + '/init-server', self.init_server)
         await self.app.register(os.getenv("GIT_NDN_PREFIX") + '/add-user', self.add_user)
+        await self.app.register(os.getenv("GIT_NDN_PREFIX") + '/metrics', self.get_metrics)
         for _, repo in self.repos.items():
+            aio.create_task(repo.pipeline.resume_fetch())
             repo.pipeline.send_sync_update()
 
     def init_repo_pipelines(self, name: str):
         objects_prefix = Name.from_str(os.getenv("GIT_NDN_PREFIX") + f'/project/{name}/objects')
-        fetcher = ObjectFetcher(self.app, self.git_repos[name], objects_prefix)
-        pipeline = RepoSyncPipeline(fetcher, self.git_repos[name], self.accounts)
+        fetcher = ObjectFetcher(self.app, self.git_repos[name], objects_prefix, signer=self.object_signer)
+        fetcher.prewarm_limit = int(os.getenv('GIT_NDN_PREWARM', '0'))
+        pack_prefix = Name.from_str(os.getenv("GIT_NDN_PREFIX") + f'/project/{name}/pack')
+        pack_fetcher = PackFetcher(self.app, self.git_repos[name], pack_prefix, signer=self.object_signer)
+        pipeline = RepoSyncPipeline(fetcher, self.git_repos[name], self.accounts, pack_fetcher)
         sync_prefix = Name.from_str(os.getenv("GIT_NDN_PREFIX") + f'/project/{name}/sync')
         # TODO: Parse the config and change to real time
         vsync = VSync(self.app, pipeline.on_update, sync_prefix, 10)
         pipeline.publish_update = vsync.publish_update
         logging.info(f'Start sync on repo: {name}')
         handler = Handler(self.app, self.git_repos[name], pipeline)
-        return Server.Repo(vsync, fetcher, pipeline, handler)
+        return Server.Repo(vsync, fetcher, pack_fetcher, pipeline, handler)
 
     def create_project(self, name: FormalName, _param: InterestParam, app_param: typing.Optional[BinaryStr]):
         repo_name = bytes(app_param).decode()
@@ -73,6 +84,11 @@ class Server:
         self.repos['All-Projects.git'].pipeline.send_sync_update(None)
         self.repos['All-Users.git'].pipeline.send_sync_update(None)
 
+    def get_metrics(self, name: FormalName, _param: InterestParam, _app_param: typing.Optional[BinaryStr]):
+        metrics = {repo_name: repo.fetcher.metrics for repo_name, repo in self.repos.items()}
+        stats = {repo_name: repo.fetcher.stats() for repo_name, repo in self.repos.items()}
+        self.app.put_data(name, export_text(metrics, stats).encode(), freshness_period=1000)
+
     def add_user(self, name: FormalName, _param: InterestParam, app_param: typing.Optional[BinaryStr]):
         try:
             req = packet.AddUserReq.parse(app_param)
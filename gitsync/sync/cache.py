@@ -0,0 +1,44 @@
+import typing
+import collections
+
+
+class LruCache:
+    # A cache bounded by the total size of its values
+    def __init__(self, max_size: int, size_of: typing.Callable[[typing.Any], int] = len):
+        self.max_size = max_size
+        self.size_of = size_of
+        self.size = 0
+        self.items = collections.OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        return key in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            self.items.move_to_end(key)
+        except KeyError:
+            return default
+        return self.items[key]
+
+    def put(self, key, value) -> bool:
+        # Values larger than the whole cache are not kept
+        size = self.size_of(value)
+        if size > self.max_size:
+            return False
+        self.pop(key)
+        self.items[key] = value
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= self.size_of(evicted)
+        return True
+
+    def pop(self, key, default=None):
+        if key not in self.items:
+            return default
+        value = self.items.pop(key)
+        self.size -= self.size_of(value)
+        return value
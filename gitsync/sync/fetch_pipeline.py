@@ -6,20 +6,33 @@ from ndn import encoding as enc
 from ndn.types import InterestCanceled, InterestTimeout, InterestNack
 from . import packet
 from .fetch_queue import ObjectFetcher
-from ..repos import GitRepo
+from .pack_fetch import PackFetcher, PACK_MIN_GAP
+from ..repos import GitRepo, RefTransaction, diff_trees
 from ..account.account import Accounts
 from ..db import proto
 from .merger import Merger
 
 
+MAX_PARALLEL_REFS = 8
+
+
 class RepoSyncPipeline:
-    def __init__(self, fetcher: ObjectFetcher, repo: GitRepo, accounts: Accounts):
+    def __init__(self, fetcher: ObjectFetcher, repo: GitRepo, accounts: Accounts,
+                 pack_fetcher: typ.Optional[PackFetcher] = None):
         self.fetcher = fetcher
+        self.pack_fetcher = pack_fetcher
         self.repo = repo
         self.accounts = accounts
         self.publish_update = None
         self.updated = False
         self.in_process = False
+        # Updates received during a round, merged by ref name
+        self.pending_updates = {}
+        self.pending_respond_to = None
+        # Refs are updated concurrently, but each ref by one task at a time, shared with push handling
+        self.ref_locks = {}
+        self.ref_slots = None
+        self.prewarmed = set()
 
     def on_update(self, data: enc.BinaryStr, respond_to: typ.Optional[bytes]):
         try:
@@ -32,40 +45,106 @@ class RepoSyncPipeline:
             for ref_info in update.ref_into
         }
         logging.debug(f'On Sync Update {ref_updates}')
-        # To avoid conflict, we can ignore other incoming Sync updates when we are handling one
-        # This is safe because we will send a Sync update after it
-        # which will trigger other nodes send back the updates we are missing
-        # A better way is to create a queue, but I don't have time to handle this corner case
+        # To avoid conflict, only one round is handled at a time.
+        # Updates arriving meanwhile are queued and handled right after the current round.
+        for name, head in ref_updates.items():
+            self.queue_update(name, head)
+        self.pending_respond_to = respond_to
         if not self.in_process:
             self.in_process = True
-            aio.create_task(self.after_update(ref_updates, respond_to))
+            aio.create_task(self.drain_updates())
+
+    def queue_update(self, name: str, head: bytes):
+        # Keep the newest candidate of a ref. Without both commits we cannot tell, so the latest wins.
+        queued = self.pending_updates.get(name)
+        if queued is not None and queued != head and self.repo.has_obj(queued) and self.repo.has_obj(head):
+            try:
+                if self.repo.is_ancestor(head, queued):
+                    return
+            except GitCommandError:
+                pass
+        self.pending_updates[name] = head
+
+    async def drain_updates(self):
+        try:
+            while self.pending_updates:
+                ref_updates, self.pending_updates = self.pending_updates, {}
+                respond_to, self.pending_respond_to = self.pending_respond_to, None
+                await self.after_update(ref_updates, respond_to)
+        finally:
+            self.in_process = False
 
     async def after_update(self, ref_updates: typ.Dict[str, bytes], respond_to: typ.Optional[bytes]):
         self.updated = False
         # TODO: Handle refs/changes-hash
-        for name, head in ref_updates.items():
+        # Updates carry every ref, most of which are the same as ours
+        local_heads = self.repo.get_ref_heads()
+        changed = {name: head for name, head in ref_updates.items() if local_heads.get(name) != head}
+        self.fetcher.metrics.refs_received += len(ref_updates)
+        self.fetcher.metrics.refs_skipped += len(ref_updates) - len(changed)
+        await aio.gather(*(self.update_ref(name, head) for name, head in changed.items()))
+        # Set Sync update
+        # It may bounce back and forth if there is an unresolvable conflict
+        # But currently we cannot detect whether it's another node who disagrees with us
+        # or it's bouncing back and forth.
+        self.send_sync_update(respond_to)
+
+    def ref_lock(self, name: str) -> aio.Lock:
+        lock = self.ref_locks.get(name)
+        if lock is None:
+            lock = aio.Lock()
+            self.ref_locks[name] = lock
+        return lock
+
+    async def update_ref(self, name: str, head: bytes) -> bool:
+        if self.ref_slots is None:
+            self.ref_slots = aio.Semaphore(MAX_PARALLEL_REFS)
+        # Take the lock first, so that a task waiting for its ref does not hold a slot
+        async with self.ref_lock(name), self.ref_slots:
             # Fetch the head
             try:
+                await self.fetch_pack(name, head)
                 await self.fetcher.fetch('commit', head)
             except (ValueError, InterestCanceled, InterestTimeout, InterestNack) as e:
                 logging.warning(f'Fetching error - {type(e)} {e}')
-                continue
+                return False
             # TODO: If this is bmeta, fetch refs/head/*
-            pass
-            # Linear update: compare history
-            ret = await self.linear_update(name, head)
-            # Merge update: for append-only branches
-            if not ret and self.is_mergable_branch(name):
-                ret = await self.merge_update(name, head)
+            # Heads are staged while the lock is held and written to the disk before it is released,
+            # so a head is durable before it is listed or published
+            with self.repo.ref_transaction() as txn:
+                # Linear update: compare history
+                ret = await self.linear_update(name, head, txn)
+                # Merge update: for append-only branches
+                if not ret and self.is_mergable_branch(name):
+                    ret = await self.merge_update(name, head, txn)
             # TODO: If this is bmeta, reset refs/head/*
-        # Set Sync update
-        # It may bounce back and forth if there is an unresolvable conflict
-        # But currently we cannot detect whether it's another node who disagrees with us
-        # or it's bouncing back and forth.
-        self.send_sync_update(respond_to)
-        self.in_process = False
+            return ret
 
-    async def linear_update(self, name: str, new_head: bytes) -> bool:
+    async def resume_fetch(self):
+        # Objects left incomplete by the last run; their refs are set by the next sync update
+        try:
+            await self.fetcher.resume()
+        except (ValueError, InterestCanceled, InterestTimeout, InterestNack) as e:
+            logging.warning(f'Resuming fetch error - {type(e)} {e}')
+
+    async def fetch_pack(self, name: str, head: bytes):
+        # Bulk transfer only pays off for a large gap: at least PACK_MIN_GAP commits missing behind the head.
+        # The commits walked to tell are kept, since they are needed either way.
+        if self.pack_fetcher is None or self.repo.has_obj(head):
+            return
+        gap = await self.fetcher.count_missing_commits(head, PACK_MIN_GAP)
+        if gap < PACK_MIN_GAP or not self.pack_fetcher.use_pack():
+            return
+        logging.info(f'Fetching a pack for {name}, which is at least {gap} commits behind')
+        haves = list(dict.fromkeys(self.repo.get_ref_heads().values()))
+        try:
+            await self.pack_fetcher.fetch([head], haves)
+        except (ValueError, IndexError, enc.DecodeError, GitCommandError,
+                InterestCanceled, InterestTimeout, InterestNack) as e:
+            # Fall back to fetching objects one by one
+            logging.warning(f'Pack fetching error - {type(e)} {e}')
+
+    async def linear_update(self, name: str, new_head: bytes, txn: RefTransaction) -> bool:
         # Try to get the original head
         try:
             ori_head = self.repo.get_head(name)
@@ -101,19 +180,20 @@ class RepoSyncPipeline:
                 break
             else:
                 logging.debug(f'Set head -> {commits[i].hexsha}')
-                # We have to write to the disk because new certs may be added here
-                self.repo.set_head(name, commits[i].binsha)
+                # New certs may be added here, which are visible once the head is staged.
+                # The last head is written to the disk when the transaction commits.
+                txn.set_head(name, commits[i].binsha)
         self.updated = True
         return True
 
-    async def merge_update(self, name: str, new_head: bytes):
+    async def merge_update(self, name: str, new_head: bytes, txn: RefTransaction):
         ori_head = self.repo.get_head(name)
         ori_commit = self.repo.get_commit(ori_head)
         new_commit = self.repo.get_commit(new_head)
         # If they are equal, randomly pick one
         if ori_commit.tree.binsha == new_commit.tree.binsha:
             if ori_head < new_head:
-                self.repo.set_head(name, new_head)
+                txn.set_head(name, new_head)
             self.updated = True
             return True
         # A common base is required (as XxxConfig.tlv is necessary)
@@ -122,24 +202,25 @@ class RepoSyncPipeline:
         except ValueError as e:
             logging.warning(f'No common base for merge {name} {new_head}->{ori_head}: {e}')
             return False
-        if merge_base.binsha == ori_head or merge_base == new_head:
+        if merge_base.binsha == ori_head or merge_base.binsha == new_head:
             logging.fatal(f'Unnecessary merge {ori_head.hex()} -- {new_head.hex()}')
-        # Do security check one by one
+        # Mergability only depends on the three trees, so it is checked once
+        merger = Merger(self.repo)
+        report = merger.merge_trees(merge_base.tree.binsha, ori_commit.tree.binsha, new_commit.tree.binsha)
+        if not report.mergeable:
+            logging.warning(f'Unable to merge {name} {new_head.hex()}->{ori_head.hex()}: {report.conflicts}')
+            return False
+        # Do security check one by one, the merge takes in every commit
         # We do not handle certs because it's too difficult
-        last = ori_commit
         commits = self.repo.list_commits(merge_base.binsha, new_head)
-        for i, commit in enumerate(commits):
+        for commit in commits:
             if not await self.security_check(name, commit):
-                break
-            elif not await self.mergability_check(merge_base, ori_commit, new_commit):
-                break
-            else:
-                last = commit
-        # If it is mergable, merge
-        if last != ori_commit:
-            ret = Merger(self.repo).create_commit(merge_base, ori_commit, new_commit)
-            self.repo.set_head(name, ret)
-            self.updated = True
+                logging.warning(f'Unable to merge {name} {new_head.hex()}->{ori_head.hex()}: '
+                                f'{commit.hexsha} fails the security check')
+                return False
+        ret = merger.create_commit(merge_base, ori_commit, new_commit, report)
+        txn.set_head(name, ret)
+        self.updated = True
         return True
 
     async def security_check(self, name: str, commit: Commit) -> bool:
@@ -157,22 +238,6 @@ class RepoSyncPipeline:
         # TODO: Do we need more?
         return True
 
-    async def mergability_check(self, merge_base: Commit, lhs: Commit, rhs: Commit):
-        for file in merge_base.tree.traverse():
-            if file.type != 'blob':
-                continue
-            path = file.path
-            try:
-                lfile = lhs.tree[path].binsha
-                rfile = rhs.tree[path].binsha
-            except KeyError:
-                # A file is missing in one branch
-                return False
-            if lfile != file.binsha and rfile != file.binsha:
-                # Both changed to a file
-                return False
-        return True
-
     @staticmethod
     def is_immutable_branch(name: str):
         # refs/changes/<__>/<Change-ID>/<PatchSet>
@@ -197,13 +262,19 @@ class RepoSyncPipeline:
         # No need to check signature for code branch
         if self.is_code_branch(name):
             return True
-        # Verify every tlv file
-        for file in commit.tree.traverse():
+        # Verify every tlv file added or changed since the first parent, which is checked before
+        parent_tree = commit.parents[0].tree if commit.parents else None
+        for _, _, file in diff_trees(parent_tree, commit.tree):
+            if file is None:
+                continue
             # Verify tlv and cert files only
             is_tlv = file.name.endswith('.tlv')
             is_cert = file.name.endswith('.cert')
             if not is_tlv and not is_cert:
                 continue
+            # Verified before with a certificate still valid
+            if self.accounts.is_verified(file.binsha):
+                continue
             # Verify the signature without considering the signer
             wire = file.data_stream.read()
             try:
@@ -214,7 +285,7 @@ class RepoSyncPipeline:
             except (ValueError, IndexError, TypeError, enc.DecodeError) as e:
                 logging.error(f'Malformed file {name}@{file.name} - {e}')
                 return False
-            if not self.accounts.verify(sig_ptrs):
+            if not self.accounts.verify(sig_ptrs, file.binsha):
                 logging.error(f'Unable to verify the signature {name}@{file.name}')
                 return False
         return True
@@ -249,3 +320,8 @@ class RepoSyncPipeline:
             ref_info.ref_head = head
             update.ref_into.append(ref_info)
         self.publish_update(update.encode(), respond_to)
+        # Other nodes are going to fetch the heads we publish
+        if self.fetcher.prewarm_limit > 0:
+            for head in set(heads.values()) - self.prewarmed:
+                self.prewarmed.add(head)
+                aio.create_task(self.fetcher.prewarm(head))
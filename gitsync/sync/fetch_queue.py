@@ -1,57 +1,835 @@
+import os
+import time
 import typing
 import logging
+import zlib
 import hashlib
+import collections
 import asyncio as aio
 from ndn.app import NDNApp
-from ndn.encoding import Component, FormalName, InterestParam, BinaryStr
+from ndn.encoding import Component, FormalName, InterestParam, BinaryStr, Name, DecodeError, Signer
+from ndn.types import InterestTimeout, InterestNack
 from ndn.app_support.segment_fetcher import segment_fetcher
-from .packet import SyncObject
+from .packet import SyncObject, ObjectBatch, BatchObject
+from .cache import LruCache
+from .journal import FetchJournal
+from .metrics import FetchMetrics
 
 
 HASH_LENGTH = 20
 SEGMENTATION_SIZE = 4000
+# Segment sizes a producer serves; the size is in the name unless it is SEGMENTATION_SIZE.
+# Larger segments do not fit in an NDN packet.
+SEGMENT_SIZES = (1000, 2000, 4000, 8000)
+# The segment size is adapted to the loss observed in every LOSS_EPOCH Interests
+LOSS_EPOCH = 64
+LOSS_HIGH = 0.1
+LOSS_LOW = 0.01
+MAX_IN_FLIGHT = 16
+GITLINK_MODE = b'160000'
+ZLIB_COMPONENT = Component.from_str('zlib')
+BATCH_COMPONENT = Component.from_str('batch')
+# Forms in which an object is served
+RAW_FORM = 'raw'
+ZLIB_FORM = 'zlib'
+BATCH_FORM = 'batch'
+# Small children of a tree are sent together in one batch
+BATCH_OBJECT_LIMIT = 16 * 1024
+BATCH_SIZE_LIMIT = 256 * 1024
+BATCH_MIN_CHILDREN = 2
+BATCH_RETRY_TIMES = 2
+BATCH_MAX_FAILURES = 3
+# A batch names the children it wants by a bitmap over the entries of the tree, unless most of them are wanted
+BATCH_WANT_PREFIX = b'want-'
+BATCH_WANT_MAX_ENTRIES = 4096
+# Producers before the zlib and size-<n> components do not answer names with them
+NAMING_RETRY_TIMES = 2
+NAMING_MAX_FAILURES = 3
+# Congestion control of windowed segment fetching, times are in milliseconds
+INIT_CWND = 2.0
+MIN_CWND = 1.0
+MAX_CWND = 128.0
+INIT_RTO = 1000.0
+MIN_RTO = 200.0
+MAX_RTO = 4000.0
+SEGMENT_RETRY_TIMES = 5
+SERVE_CACHE_SIZE = 64 * 1024 * 1024
+STREAM_THRESHOLD = 1024 * 1024
+WIRE_CACHE_SIZE = 64 * 1024 * 1024
+MAX_HEADER_LENGTH = 32
+
+
+class Payload(typing.NamedTuple):
+    # An object in the form it is sent; data is None for big objects read segment by segment
+    obj_type: str
+    data: typing.Optional[bytes]
+    size: int
+    compressed: bool
+    version: typing.Optional[int]
+    # Children wanted in a batch, None for all
+    want: typing.Optional[bytes] = None
+
+
+def configured_segment_size() -> int:
+    # The largest segment size to use, configured by GIT_NDN_SEGMENT_SIZE
+    size = int(os.getenv('GIT_NDN_SEGMENT_SIZE', str(SEGMENT_SIZES[-1])))
+    return max([s for s in SEGMENT_SIZES if s <= size] or [SEGMENT_SIZES[0]])
+
+
+def segment_size_component(size: int) -> typing.List[bytes]:
+    if size == SEGMENTATION_SIZE:
+        return []
+    return [Component.from_str(f'size-{size}')]
+
+
+def batch_want(entries: typing.List[typing.Tuple[str, bytes]],
+               children: typing.List[typing.Tuple[str, bytes]]) -> typing.Optional[bytes]:
+    # Bitmap of the children over the entries of their tree, None if most entries are children
+    if len(children) * 2 >= len(entries):
+        return None
+    wanted = {child_name for _, child_name in children}
+    bits = bytearray((len(entries) + 7) // 8)
+    for i, (_, entry_name) in enumerate(entries):
+        if entry_name in wanted:
+            bits[i // 8] |= 0x80 >> (i % 8)
+    return bytes(bits)
+
+
+def batch_want_component(want: typing.Optional[bytes]) -> typing.List[bytes]:
+    if want is None:
+        return []
+    return [Component.from_bytes(BATCH_WANT_PREFIX + want.hex().encode())]
+
+
+def parse_batch_want(comp: BinaryStr) -> typing.Optional[bytes]:
+    value = bytes(Component.get_value(comp))
+    if Component.get_type(comp) != Component.TYPE_GENERIC or not value.startswith(BATCH_WANT_PREFIX):
+        return None
+    try:
+        return bytes.fromhex(value[len(BATCH_WANT_PREFIX):].decode())
+    except ValueError:
+        return None
+
+
+def parse_segment_size(comp: BinaryStr) -> typing.Optional[int]:
+    value = bytes(Component.get_value(comp))
+    if Component.get_type(comp) != Component.TYPE_GENERIC or not value.startswith(b'size-'):
+        return None
+    try:
+        size = int(value[len(b'size-'):])
+    except ValueError:
+        return None
+    return size if size in SEGMENT_SIZES else None
+
+
+class SegmentWindow:
+    # AIMD congestion window with RTT estimation (RFC 6298).
+    # One window is shared by all objects fetched under the same prefix.
+    # It also chooses the segment size, stepping down on loss, e.g. on a face with a small MTU.
+    def __init__(self, max_segment_size: typing.Optional[int] = None):
+        self.cwnd = INIT_CWND
+        self.ssthresh = MAX_CWND
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INIT_RTO
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.waiters = collections.deque()
+        self.max_segment_size = max_segment_size or configured_segment_size()
+        self.segment_size = self.max_segment_size
+        self.epoch_sent = 0
+        self.epoch_lost = 0
+
+    async def acquire(self):
+        while self.in_flight >= int(self.cwnd):
+            fut = aio.get_event_loop().create_future()
+            self.waiters.append(fut)
+            try:
+                await fut
+            except aio.CancelledError:
+                # We may have been woken up before being cancelled; pass the slot on
+                self.wake_up()
+                raise
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake_up()
+
+    def wake_up(self):
+        room = int(self.cwnd) - self.in_flight
+        while room > 0 and self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                room -= 1
+
+    def on_data(self, rtt: typing.Optional[float]):
+        # Karn's algorithm: rtt is None for retransmitted segments
+        if rtt is not None:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1.0
+        else:
+            self.cwnd += 1.0 / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_CWND)
+        self.count_loss(False)
+        self.wake_up()
+
+    def on_timeout(self):
+        # Decrease at most once per RTT, since a burst of losses is one congestion event
+        now = time.monotonic() * 1000
+        if now - self.last_decrease >= (self.srtt or self.rto):
+            self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+            self.cwnd = self.ssthresh
+            self.last_decrease = now
+        self.rto = min(self.rto * 2, MAX_RTO)
+        self.count_loss(True)
+
+    def count_loss(self, lost: bool):
+        self.epoch_sent += 1
+        self.epoch_lost += lost
+        if self.epoch_sent < LOSS_EPOCH:
+            return
+        loss = self.epoch_lost / self.epoch_sent
+        i = SEGMENT_SIZES.index(self.segment_size)
+        if loss > LOSS_HIGH and i > 0:
+            self.segment_size = SEGMENT_SIZES[i - 1]
+        elif loss < LOSS_LOW and self.segment_size < self.max_segment_size:
+            self.segment_size = SEGMENT_SIZES[i + 1]
+        self.epoch_sent = 0
+        self.epoch_lost = 0
+
+
+async def windowed_segment_fetcher(app: NDNApp, name: FormalName, window: SegmentWindow,
+                                   must_be_fresh: bool = False, retry_times: int = SEGMENT_RETRY_TIMES,
+                                   metrics: typing.Optional[FetchMetrics] = None):
+    # Fetch a segmented object keeping up to window.cwnd Interests in flight.
+    # Lost segments are retransmitted individually. Segments are yielded in order.
+    async def express(seg_name: FormalName, can_be_prefix: bool, is_retx: bool):
+        await window.acquire()
+        if metrics is not None:
+            metrics.interests += 1
+            metrics.retransmits += is_retx
+        start = time.monotonic()
+        try:
+            ret = await app.express_interest(seg_name, can_be_prefix=can_be_prefix,
+                                             must_be_fresh=must_be_fresh, lifetime=int(window.rto))
+        except InterestTimeout:
+            window.on_timeout()
+            if metrics is not None:
+                metrics.timeouts += 1
+            raise
+        except InterestNack:
+            if metrics is not None:
+                metrics.nacks += 1
+            raise
+        finally:
+            window.release()
+        window.on_data(None if is_retx else (time.monotonic() - start) * 1000)
+        return ret
+
+    # First Interest, to learn the full name and the number of segments
+    trial_times = 0
+    while True:
+        try:
+            name, meta, content = await express(Name.normalize(name), True, trial_times > 0)
+            break
+        except InterestTimeout:
+            trial_times += 1
+            if trial_times >= retry_times:
+                raise
+    # If it's not segmented
+    if Component.get_type(name[-1]) != Component.TYPE_SEGMENT:
+        yield content
+        return
+    final_seg = Component.to_number(meta.final_block_id) if meta.final_block_id else 0
+    received = {}
+    next_seg = 0
+    if Component.to_number(name[-1]) == 0:
+        received[0] = content
+        next_seg = 1
+    prefix = name[:-1]
+    pending = {}
+    retries = collections.defaultdict(int)
+    next_yield = 0
+    try:
+        while next_yield <= final_seg:
+            while next_yield in received:
+                yield received.pop(next_yield)
+                next_yield += 1
+            if next_yield > final_seg:
+                break
+            # Out-of-order segments waiting for a retransmission are bounded by MAX_CWND
+            while (next_seg <= final_seg and len(pending) < max(int(window.cwnd), 1)
+                   and next_seg - next_yield < MAX_CWND):
+                pending[next_seg] = aio.create_task(
+                    express(prefix + [Component.from_segment(next_seg)], False, False))
+                next_seg += 1
+            await aio.wait(pending.values(), return_when=aio.FIRST_COMPLETED)
+            for seg_no, task in list(pending.items()):
+                if not task.done():
+                    continue
+                del pending[seg_no]
+                try:
+                    _, _, received[seg_no] = task.result()
+                except InterestTimeout:
+                    retries[seg_no] += 1
+                    if retries[seg_no] >= retry_times:
+                        raise
+                    # Selective retransmission of the missing segment
+                    pending[seg_no] = aio.create_task(
+                        express(prefix + [Component.from_segment(seg_no)], False, True))
+    finally:
+        for task in pending.values():
+            task.cancel()
+
+
+class ObjectIngest:
+    # Verifies an object segment by segment and writes it into the object store as it arrives.
+    # Blobs have no children, so only the content of trees and commits is kept.
+    def __init__(self, obj_type: str, obj_name: bytes, writer, metrics: FetchMetrics):
+        self.obj_type = obj_type
+        self.obj_name = obj_name
+        self.writer = writer
+        self.metrics = metrics
+        self.compressed = None
+        self.inflater = zlib.decompressobj()
+        self.h = hashlib.sha1()
+        self.header = b''
+        self.obj_size = None
+        self.received = 0
+        self.content = []
+        self.pending = []
+
+    def feed(self, seg: BinaryStr):
+        pack = SyncObject.parse(seg, ignore_critical=True)
+        fetched_obj_type = bytes(pack.obj_type).decode()
+        if self.compressed is None:
+            if self.obj_type and self.obj_type != fetched_obj_type:
+                raise ValueError(f'{self.obj_type} is expected but get {fetched_obj_type}')
+            self.obj_type = fetched_obj_type
+            self.compressed = bool(pack.compressed)
+            if not self.compressed and pack.obj_size is not None:
+                self.start(pack.obj_size)
+        elif self.obj_type != fetched_obj_type or self.compressed != bool(pack.compressed):
+            raise ValueError(f'{self.obj_name.hex()} is sent in mixed forms')
+        data_seg = pack.obj_data if pack.obj_data is not None else b''
+        if self.compressed:
+            if self.inflater.eof and data_seg:
+                raise ValueError(f'{self.obj_name.hex()} has data after the end of its stream')
+            self.write(self.writer.write_compressed, data_seg)
+            start = time.perf_counter()
+            try:
+                out = self.inflater.decompress(data_seg)
+            except zlib.error as e:
+                raise ValueError(f'{self.obj_name.hex()} is not properly compressed: {e}')
+            if self.inflater.unused_data:
+                raise ValueError(f'{self.obj_name.hex()} has data after the end of its stream')
+            self.h.update(out)
+            self.metrics.hash_seconds += time.perf_counter() - start
+            if self.obj_size is None:
+                # The inflated data starts with the header
+                self.header += out
+                header, sep, out = self.header.partition(b'\x00')
+                if not sep:
+                    if len(self.header) > MAX_HEADER_LENGTH:
+                        raise ValueError(f'{self.obj_name.hex()} has a malformed header')
+                    return
+                header_type, _, header_size = header.partition(b' ')
+                if header_type != self.obj_type.encode() or not header_size.isdigit():
+                    raise ValueError(f'{self.obj_name.hex()} has a malformed header')
+                self.obj_size = int(header_size)
+            self.add_data(out)
+        elif self.obj_size is None:
+            # An old producer does not tell the size, so the object has to be held until the end
+            self.pending.append(bytes(data_seg))
+        else:
+            self.update_hash(data_seg)
+            self.write(self.writer.write_raw, data_seg)
+            self.add_data(data_seg)
+
+    def update_hash(self, data: BinaryStr):
+        start = time.perf_counter()
+        self.h.update(data)
+        self.metrics.hash_seconds += time.perf_counter() - start
+
+    def write(self, func, data: BinaryStr):
+        start = time.perf_counter()
+        func(data)
+        self.metrics.store_seconds += time.perf_counter() - start
+
+    def start(self, obj_size: int):
+        self.obj_size = obj_size
+        header = self.obj_type.encode() + b' ' + f'{obj_size}'.encode() + b'\x00'
+        self.update_hash(header)
+        self.write(self.writer.write_raw, header)
+
+    def add_data(self, data: BinaryStr):
+        self.received += len(data)
+        if self.received > self.obj_size:
+            raise ValueError(f'{self.obj_name.hex()} is larger than its size')
+        if self.obj_type != 'blob':
+            self.content.append(bytes(data))
+
+    def finish(self) -> bytes:
+        if self.compressed is None:
+            raise ValueError(f'{self.obj_name.hex()} is empty')
+        if self.pending:
+            data = b''.join(self.pending)
+            self.pending = []
+            self.start(len(data))
+            self.update_hash(data)
+            self.write(self.writer.write_raw, data)
+            self.add_data(data)
+        elif not self.compressed and self.obj_size is None:
+            self.start(0)
+        if self.compressed and not self.inflater.eof:
+            raise ValueError(f'{self.obj_name.hex()} is truncated')
+        if self.compressed and self.inflater.unused_data:
+            raise ValueError(f'{self.obj_name.hex()} has data after the end of its stream')
+        if self.received != self.obj_size:
+            raise ValueError(f'{self.obj_name.hex()} is smaller than its size')
+        if self.h.digest() != self.obj_name:
+            raise ValueError(f'{self.obj_name.hex()} has a different digest')
+        return b''.join(self.content)
 
 
 class ObjectFetcher:
-    def __init__(self, app: NDNApp, repo, prefix: FormalName):
+    def __init__(self, app: NDNApp, repo, prefix: FormalName, max_in_flight: int = MAX_IN_FLIGHT,
+                 windowed: bool = True, compressed: bool = True, signer: typing.Optional[Signer] = None):
         self.app = app
         self.repo = repo
         self.prefix = prefix
+        self.max_in_flight = max_in_flight
+        self.compressed = compressed
+        self.window = SegmentWindow() if windowed else None
         aio.create_task(self.app.register(self.prefix, self.on_interest))
-        self.incomplete_list = {}
+        self.journal = FetchJournal(repo.git_dir)
+        self.incomplete_list = self.journal.load()
+        # Objects being fetched, shared by concurrent traversals
+        self.pending = {}
+        self.pending_users = {}
+        self.fetch_coalesced = 0
+        self.metrics = FetchMetrics()
+        # Commits whose parents are left out by a shallow fetch
+        self.shallow = set()
+        # Batches are not used after consecutive failures, e.g. with a producer not supporting them
+        self.batch_supported = False
+        self.batch_probing = False
+        self.batch_failures = 0
+        # Likewise, objects are fetched by plain names after consecutive failures with the zlib or size-<n> component
+        self.naming_supported = False
+        self.naming_probing = False
+        self.naming_failures = 0
+        # Objects recently served, keyed by (name, form, children wanted in a batch)
+        self.serve_cache = LruCache(SERVE_CACHE_SIZE,
+                                    size_of=lambda payload: len(payload.data) if payload.data is not None else 1)
+        self.loading = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_coalesced = 0
+        # Signed segments, keyed by (name, form, children wanted, segment size, version, segment number)
+        self.wires = LruCache(WIRE_CACHE_SIZE, size_of=len)
+        self.wire_hits = 0
+        # None signs segments with the default key
+        self.signer = signer
+        # Number of objects signed ahead for a new head, 0 to disable
+        self.prewarm_limit = 0
 
     def close(self):
         self.app.unregister(self.prefix)
 
-    async def fetch(self, obj_type: str, obj_name: bytes):
+    def stats(self) -> typing.Dict[str, float]:
+        # Counters kept outside FetchMetrics: coalesced fetches, serving caches and the object index
+        ret = {
+            'fetch_coalesced_total': self.fetch_coalesced,
+            'serve_cache_hits_total': self.cache_hits,
+            'serve_cache_misses_total': self.cache_misses,
+            'serve_cache_coalesced_total': self.cache_coalesced,
+            'wire_hits_total': self.wire_hits,
+        }
+        index_stats = self.repo.obj_index.stats()
+        ret.update({
+            'object_index_entries': index_stats['entries'],
+            'object_index_memory_bytes': index_stats['memory_bytes'],
+            'object_index_lookups_total': index_stats['lookups'],
+            'object_index_hits_total': index_stats['hits'],
+            'object_index_stale_misses_total': index_stats['stale_misses'],
+            'object_index_false_positives_total': index_stats['false_positives'],
+        })
+        return ret
+
+    async def fetch(self, obj_type: str, obj_name: bytes, depth: typing.Optional[int] = None,
+                    since: typing.Optional[int] = None, blob_limit: typing.Optional[int] = None) -> bool:
+        # depth and since (a Unix time) limit the history fetched, as git fetch --depth and --shallow-since
+        # Blobs larger than blob_limit are left out, as git fetch --filter; -1 leaves out all blobs
         # Return if it exists
-        if self.repo.has_obj(obj_name) and obj_name not in self.incomplete_list:
+        if self.is_complete(obj_type, obj_name, depth, since):
             return False
-        self.incomplete_list[obj_name] = obj_type
+        await self.traverse([(obj_type, obj_name)], depth, since, blob_limit)
+        return True
+
+    async def resume(self):
+        # Continue the fetch interrupted last time, only the journaled objects are checked again
+        if self.incomplete_list:
+            await self.traverse([(obj_type, obj_name) for obj_name, obj_type in self.incomplete_list.items()])
+
+    async def traverse(self, roots: typing.List[typing.Tuple[str, bytes]], depth: typing.Optional[int] = None,
+                       since: typing.Optional[int] = None, blob_limit: typing.Optional[int] = None):
+        # An object stays in incomplete_list until all objects it refers to are complete.
+        # waiting[x] is the number of incomplete children of x; parents[x] are the objects waiting for x.
+        # depths[x] is the depth of commit x, counting the roots as 1.
+        frontier = collections.deque(roots)
+        roots_set = {obj_name for _, obj_name in roots}
+        depths = {}
+        batches = {}
+        seen = {obj_name for _, obj_name in roots}
+        waiting = {}
+        parents = collections.defaultdict(list)
+        tasks = {}
+        self.mark_incomplete(roots)
+        self.metrics.fetch_started()
+        try:
+            while frontier or tasks:
+                while frontier and len(tasks) < self.max_in_flight:
+                    expect_type, name = frontier.popleft()
+                    if expect_type == BATCH_FORM:
+                        key = (name, BATCH_FORM)
+                    else:
+                        # Roots are never filtered
+                        key = (name, None if name in roots_set else blob_limit)
+                    tasks[self.fetch_shared(expect_type, key, batches.get(name))] = (expect_type, key)
+                done, _ = await aio.wait(tasks.keys(), return_when=aio.FIRST_COMPLETED)
+                for task in done:
+                    expect_type, (name, _) = tasks.pop(task)
+                    if expect_type == BATCH_FORM:
+                        # Children in the batch are now local, the others are fetched one by one
+                        task.result()
+                        frontier.extend(batches.pop(name))
+                        continue
+                    fetched_type, content = task.result()
+                    if expect_type and expect_type != fetched_type:
+                        raise ValueError(f'{expect_type} is expected but get {fetched_type}')
+                    if content is None:
+                        # Filtered out: it stays missing, promised by the objects referring to it
+                        self.complete(name, waiting, parents)
+                        continue
+                    if fetched_type == 'commit':
+                        self.repo.commit_graph.add(name, content)
+                    waiting[name] = 0
+                    children = []
+                    for child_type, child_name in self.limit_history(name, fetched_type, content,
+                                                                     depths, depth, since):
+                        if child_name in seen:
+                            # Already queued by this fetch; wait for it if it is not finished yet
+                            if child_name in self.incomplete_list:
+                                parents[child_name].append(name)
+                                waiting[name] += 1
+                            continue
+                        if self.is_complete(child_type, child_name, depth, since):
+                            continue
+                        if child_type == 'blob' and blob_limit is not None and blob_limit < 0:
+                            self.metrics.filtered += 1
+                            continue
+                        seen.add(child_name)
+                        children.append((child_type, child_name))
+                        parents[child_name].append(name)
+                        waiting[name] += 1
+                    # Journaled before they are fetched
+                    self.mark_incomplete(children)
+                    if (fetched_type == 'tree' and blob_limit is None and len(children) >= BATCH_MIN_CHILDREN
+                            and self.batchable(content, children) and self.use_batch()):
+                        batches[name] = children
+                        frontier.append((BATCH_FORM, name))
+                    else:
+                        frontier.extend(children)
+                    if waiting[name] == 0:
+                        self.complete(name, waiting, parents)
+        finally:
+            # On failure, unfinished objects are left in incomplete_list and will be fetched again next time
+            for task, (_, key) in tasks.items():
+                self.release_shared(key, task)
+            self.metrics.fetch_stopped()
+            if not self.incomplete_list:
+                self.journal.compact(self.incomplete_list)
+
+    def batchable(self, content: bytes, children: typing.List[typing.Tuple[str, bytes]]) -> bool:
+        # A large tree with a few children missing is not worth a bitmap in the name
+        entries = self.traverse_tree(content)
+        return batch_want(entries, children) is None or len(entries) <= BATCH_WANT_MAX_ENTRIES
+
+    def use_batch(self) -> bool:
+        # Until a batch succeeds, one batch at a time probes whether the producer supports them
+        if self.batch_failures >= BATCH_MAX_FAILURES:
+            return False
+        if self.batch_supported:
+            return True
+        if self.batch_probing:
+            return False
+        self.batch_probing = True
+        return True
+
+    async def fetch_batch(self, tree_name: bytes, children: typing.List[typing.Tuple[str, bytes]]):
+        # Store the small children of a tree, each verified by its own hash.
+        # Any failure is not fatal, since the children are also fetched one by one.
+        wanted = dict((child_name, child_type) for child_type, child_name in children)
+        try:
+            # Only the children missing here are asked for, unless they are most of the tree
+            _, content = self.repo.read_obj(tree_name)
+            want = batch_want(self.traverse_tree(content), children)
+            packet_name = (self.prefix + [Component.from_bytes(tree_name), BATCH_COMPONENT]
+                           + batch_want_component(want))
+            if self.window is not None:
+                packet_name += segment_size_component(self.window.segment_size)
+                seg_iter = windowed_segment_fetcher(self.app, packet_name, self.window, must_be_fresh=False,
+                                                    retry_times=BATCH_RETRY_TIMES, metrics=self.metrics)
+            else:
+                seg_iter = segment_fetcher(self.app, packet_name, must_be_fresh=False,
+                                           retry_times=BATCH_RETRY_TIMES)
+            wire = b''.join([bytes(seg) async for seg in seg_iter])
+            batch = ObjectBatch.parse(wire, ignore_critical=True)
+        except (ValueError, IndexError, DecodeError, InterestTimeout, InterestNack) as e:
+            self.batch_failures += 1
+            logging.debug(f'Unable to fetch the batch of {tree_name.hex()} - {type(e)} {e}')
+            return
+        finally:
+            self.batch_probing = False
+        self.batch_supported = True
+        self.batch_failures = 0
+        self.metrics.batches += 1
+        self.metrics.bytes_received += len(wire)
+        for obj in batch.objects or []:
+            obj_name = bytes(obj.obj_name)
+            obj_type = bytes(obj.obj_type).decode()
+            data = obj.obj_data if obj.obj_data is not None else b''
+            if wanted.get(obj_name) != obj_type or self.repo.has_obj(obj_name):
+                continue
+            header = obj_type.encode() + b' ' + f'{len(data)}'.encode() + b'\x00'
+            h = hashlib.sha1(header)
+            h.update(data)
+            if h.digest() != obj_name:
+                logging.warning(f'{obj_name.hex()} in the batch of {tree_name.hex()} has a different digest')
+                continue
+            writer = self.repo.open_writer()
+            try:
+                writer.write_raw(header)
+                writer.write_raw(data)
+            except BaseException:
+                writer.abort()
+                raise
+            writer.commit(obj_name)
+            self.metrics.objects[obj_type] += 1
+
+    def fetch_shared(self, obj_type: str, key: typing.Tuple[bytes, typing.Union[int, str, None]],
+                     children: typing.Optional[typing.List[typing.Tuple[str, bytes]]] = None) -> aio.Task:
+        # key is the object name and the blob size limit, or BATCH_FORM for the batch of a tree
+        if key in self.pending:
+            self.fetch_coalesced += 1
+            self.pending_users[key] += 1
+            return self.pending[key]
+        if obj_type == BATCH_FORM:
+            task = aio.create_task(self.fetch_batch(key[0], children))
+        else:
+            task = aio.create_task(self.fetch_object(obj_type, *key))
+        self.pending[key] = task
+        self.pending_users[key] = 1
+        task.add_done_callback(lambda _: self.forget_shared(key, task))
+        return task
+
+    def forget_shared(self, key: typing.Tuple[bytes, typing.Union[int, str, None]], task: aio.Task):
+        if self.pending.get(key) is task:
+            del self.pending[key]
+            del self.pending_users[key]
+
+    def release_shared(self, key: typing.Tuple[bytes, typing.Union[int, str, None]], task: aio.Task):
+        # The fetch is canceled when no traversal waits for it any more
+        if self.pending.get(key) is not task:
+            return
+        self.pending_users[key] -= 1
+        if self.pending_users[key] == 0:
+            task.cancel()
+
+    def is_complete(self, obj_type: str, obj_name: bytes, depth: typing.Optional[int],
+                    since: typing.Optional[int]) -> bool:
+        if not self.repo.has_obj(obj_name) or obj_name in self.incomplete_list:
+            return False
+        # To deepen a shallow history, local commits are walked again down to the shallow boundary
+        if self.shallow and obj_type == 'commit' and (depth is not None or since is not None):
+            return False
+        return True
+
+    async def count_missing_commits(self, head: bytes, limit: int) -> int:
+        # Commits missing from head back to the local history, counted up to limit.
+        # The commits are stored and journaled as incomplete, so a later fetch continues from them.
+        count = 0
+        level = [head]
+        seen = {head}
+        while level and count < limit:
+            level = [commit for commit in level if not self.is_complete('commit', commit, None, None)]
+            count += len(level)
+            self.mark_incomplete([('commit', commit) for commit in level])
+            results = await aio.gather(*(self.fetch_object('commit', commit) for commit in level))
+            next_level = []
+            for commit, (_, content) in zip(level, results):
+                for child_type, child_name in self.traverse_commit(content):
+                    if child_type == 'commit' and child_name not in seen:
+                        seen.add(child_name)
+                        next_level.append(child_name)
+            level = next_level
+        return count
+
+    def limit_history(self, obj_name: bytes, obj_type: str, content: bytes, depths: typing.Dict[bytes, int],
+                      depth: typing.Optional[int],
+                      since: typing.Optional[int]) -> typing.List[typing.Tuple[str, bytes]]:
+        children = self.list_children(obj_type, content)
+        if obj_type != 'commit':
+            return children
+        commit_depth = depths.get(obj_name, 1)
+        # The first commit older than since is kept as the boundary
+        if ((depth is not None and commit_depth >= depth)
+                or (since is not None and self.commit_time(content) < since)):
+            if any(child_type == 'commit' for child_type, _ in children):
+                self.shallow.add(obj_name)
+            return [(child_type, child_name) for child_type, child_name in children if child_type != 'commit']
+        self.shallow.discard(obj_name)
+        for child_type, child_name in children:
+            if child_type == 'commit':
+                depths[child_name] = min(depths.get(child_name, commit_depth + 1), commit_depth + 1)
+        return children
+
+    def mark_incomplete(self, objects: typing.List[typing.Tuple[str, bytes]]):
+        objects = [(obj_type, obj_name) for obj_type, obj_name in objects if obj_name not in self.incomplete_list]
+        self.journal.append(objects)
+        for obj_type, obj_name in objects:
+            self.incomplete_list[obj_name] = obj_type
+
+    def complete(self, obj_name: bytes, waiting: typing.Dict[bytes, int],
+                 parents: typing.Dict[bytes, typing.List[bytes]]):
+        stack = [obj_name]
+        completed = []
+        while stack:
+            name = stack.pop()
+            if self.incomplete_list.pop(name, None) is not None:
+                completed.append(name)
+            for parent in parents.pop(name, []):
+                waiting[parent] -= 1
+                if waiting[parent] == 0:
+                    stack.append(parent)
+        self.journal.append([], completed)
+        self.journal.maybe_compact(self.incomplete_list)
+
+    async def fetch_object(self, obj_type: str, obj_name: bytes,
+                           blob_limit: typing.Optional[int] = None) -> typing.Tuple[str, typing.Optional[bytes]]:
+        # The content is None if it is a blob larger than blob_limit, which is not stored
+        # An incomplete object may have been stored by an interrupted fetch
+        if self.repo.has_obj(obj_name):
+            try:
+                fetched_obj_type, _ = self.repo.obj_info(obj_name)
+            except ValueError:
+                fetched_obj_type = None
+                self.repo.obj_index.discard(obj_name)
+            if fetched_obj_type is not None:
+                if obj_type and obj_type != fetched_obj_type:
+                    raise ValueError(f'{obj_type} is expected but get {fetched_obj_type}')
+                if fetched_obj_type == 'blob':
+                    return fetched_obj_type, b''
+                return self.repo.read_obj(obj_name)
         # Fetch object
         packet_name = self.prefix + [Component.from_bytes(obj_name)]
-        wire = b''.join([bytes(seg) async for seg in segment_fetcher(self.app, packet_name, must_be_fresh=False)])
-        pack = SyncObject.parse(wire, ignore_critical=True)
-        fetched_obj_type = bytes(pack.obj_type).decode()
-        # Check type
-        if obj_type and obj_type != fetched_obj_type:
-            raise ValueError(f'{obj_type} is expected but get {fetched_obj_type}')
-        # Write into repo TODO: Transfer compressed data
-        h = hashlib.sha1(obj_type.encode() + b' ' + f'{len(pack.obj_data)}'.encode() + b'\x00')
-        h.update(pack.obj_data)
-        if h.digest() != obj_name:
-            raise ValueError(f'{obj_name} has a different digest')
-        self.repo.store_obj(bytes(pack.obj_type), bytes(pack.obj_data))
-        # Trigger recurisve fetching
+        plain_name = list(packet_name)
+        if self.compressed:
+            packet_name.append(ZLIB_COMPONENT)
+        if self.window is not None:
+            packet_name += segment_size_component(self.window.segment_size)
+        if packet_name == plain_name:
+            return await self.fetch_segments(obj_type, obj_name, blob_limit, packet_name)
+        if not self.use_naming():
+            return await self.fetch_segments(obj_type, obj_name, blob_limit, plain_name)
+        retry_times = None if self.naming_supported else NAMING_RETRY_TIMES
+        try:
+            ret = await self.fetch_segments(obj_type, obj_name, blob_limit, packet_name, retry_times)
+        except (InterestTimeout, InterestNack) as e:
+            if self.naming_supported:
+                raise
+            self.naming_failures += 1
+            logging.debug(f'Unable to fetch {obj_name.hex()} by {Name.to_str(packet_name)}, '
+                          f'falling back to the plain name - {type(e)} {e}')
+            return await self.fetch_segments(obj_type, obj_name, blob_limit, plain_name)
+        finally:
+            self.naming_probing = False
+        self.naming_supported = True
+        self.naming_failures = 0
+        return ret
+
+    def use_naming(self) -> bool:
+        # Until an object is fetched with them, one fetch at a time probes whether the producer knows the components
+        if self.naming_failures >= NAMING_MAX_FAILURES:
+            return False
+        if self.naming_supported:
+            return True
+        if self.naming_probing:
+            return False
+        self.naming_probing = True
+        return True
+
+    async def fetch_segments(self, obj_type: str, obj_name: bytes, blob_limit: typing.Optional[int],
+                             packet_name: FormalName, retry_times: typing.Optional[int] = None):
+        # retry_times is None to use the default of the segment fetcher
+        kwargs = {'retry_times': retry_times} if retry_times is not None else {}
+        if self.window is not None:
+            seg_iter = windowed_segment_fetcher(self.app, packet_name, self.window, must_be_fresh=False,
+                                                metrics=self.metrics, **kwargs)
+        else:
+            seg_iter = segment_fetcher(self.app, packet_name, must_be_fresh=False, **kwargs)
+        start = time.monotonic()
+        segments = 0
+        received = 0
+        writer = self.repo.open_writer()
+        try:
+            ingest = ObjectIngest(obj_type, obj_name, writer, self.metrics)
+            filtered = False
+            async for seg in seg_iter:
+                segments += 1
+                received += len(seg)
+                ingest.feed(seg)
+                # The size is known from the first segment
+                if (blob_limit is not None and ingest.obj_type == 'blob'
+                        and ingest.obj_size is not None and ingest.obj_size > blob_limit):
+                    filtered = True
+                    break
+            if filtered:
+                await seg_iter.aclose()
+                writer.abort()
+                self.metrics.filtered += 1
+                return ingest.obj_type, None
+            content = ingest.finish()
+        except BaseException:
+            writer.abort()
+            raise
+        ingest.write(writer.commit, obj_name)
+        self.metrics.object_fetched(ingest.obj_type, received, segments, (time.monotonic() - start) * 1000)
+        return ingest.obj_type, content
+
+    def list_children(self, obj_type: str, content: bytes) -> typing.List[typing.Tuple[str, bytes]]:
         if obj_type == "commit":
-            await self.traverse_commit(bytes(pack.obj_data))
+            return self.traverse_commit(content)
         elif obj_type == "tree":
-            await self.traverse_tree(bytes(pack.obj_data))
-        elif obj_type != "blob":
+            return self.traverse_tree(content)
+        elif obj_type == "blob":
+            return []
+        else:
             raise ValueError(f'Unknown data type {obj_type}')
-        del self.incomplete_list[obj_name]
 
-    async def traverse_commit(self, content: bytes):
+    @staticmethod
+    def traverse_commit(content: bytes) -> typing.List[typing.Tuple[str, bytes]]:
+        ret = []
         lines = content.decode("utf-8").split("\n")
         for ln in lines:
             if not ln.startswith("tree") and not ln.startswith("parent"):
@@ -59,46 +837,248 @@ class ObjectFetcher:
             expect_type, hash_name = ln.split(" ")
             if expect_type == "parent":
                 expect_type = "commit"
-            await self.fetch(expect_type, bytes.fromhex(hash_name))
+            ret.append((expect_type, bytes.fromhex(hash_name)))
+        return ret
 
-    async def traverse_tree(self, content: bytes):
+    @staticmethod
+    def commit_time(content: bytes) -> int:
+        for ln in content.split(b'\n'):
+            if ln.startswith(b'committer '):
+                return int(ln.rsplit(b' ', 2)[1])
+            if not ln:
+                break
+        raise ValueError('Commit has no committer')
+
+    @staticmethod
+    def traverse_tree(content: bytes) -> typing.List[typing.Tuple[str, bytes]]:
+        ret = []
         size = len(content)
         pos = 0
         while pos < size:
             name_start = content.find(b'\x00', pos)
             hash_name = content[name_start+1:name_start+HASH_LENGTH+1]
-            if content[pos] == ord('1'):
+            mode = content[pos:content.find(b' ', pos)]
+            pos = name_start + HASH_LENGTH + 1
+            if mode == GITLINK_MODE:
+                # Submodule commits do not belong to this repo
+                continue
+            elif mode[0] == ord('1'):
                 expect_type = "blob"
             else:
                 expect_type = "tree"
-            await self.fetch(expect_type, hash_name)
-            pos = name_start + HASH_LENGTH + 1
+            ret.append((expect_type, hash_name))
+        return ret
 
     def on_interest(self, name: FormalName, _param: InterestParam, _app_param: typing.Optional[BinaryStr]):
-        # Get the name and segment number
-        if Component.get_type(name[-1]) == Component.TYPE_SEGMENT:
-            obj_name = Component.get_value(name[-2])
-            seg_no = Component.to_number(name[-1])
+        # Get the name and segment number: <prefix>/<sha>[/zlib|/batch[/want-<bitmap>]][/size-<n>][/<version>][/<seg>]
+        rest = name[len(self.prefix):]
+        seg_no = 0
+        if rest and Component.get_type(rest[-1]) == Component.TYPE_SEGMENT:
+            seg_no = Component.to_number(rest[-1])
+            rest = rest[:-1]
+        if not rest:
+            return
+        obj_name = bytes(Component.get_value(rest[0]))
+        form = RAW_FORM
+        want = None
+        version = None
+        seg_size = SEGMENTATION_SIZE
+        for comp in rest[1:]:
+            if comp == ZLIB_COMPONENT:
+                form = ZLIB_FORM
+            elif comp == BATCH_COMPONENT:
+                form = BATCH_FORM
+            elif Component.get_type(comp) == Component.TYPE_VERSION:
+                version = Component.to_number(comp)
+            elif form == BATCH_FORM and want is None and parse_batch_want(comp) is not None:
+                want = parse_batch_want(comp)
+            else:
+                seg_size = parse_segment_size(comp)
+                if seg_size is None:
+                    return
+        key = (obj_name, form, want)
+        payload = self.serve_cache.get(key)
+        # Segments signed before are sent as they are. Without a version, only those of the version being served.
+        if version is not None or payload is not None:
+            wire = self.wires.get((obj_name, form, want, seg_size,
+                                   version if version is not None else payload.version, seg_no))
+            if wire is not None:
+                self.wire_hits += 1
+                self.app.put_raw_packet(wire)
+                return
+        # Serve from the cache, or wait for the object being read
+        if payload is not None:
+            self.cache_hits += 1
+            self.put_segment(obj_name, payload, version, seg_no, seg_size)
+        elif key in self.loading:
+            self.cache_coalesced += 1
+            self.loading[key].append((version, seg_no, seg_size))
         else:
-            obj_name = Component.get_value(name[-1])
-            seg_no = 0
-        # Read the data
-        # Git objects are small so we can read the whole object
+            # Reading is deferred so that a burst of Interests for one object shares a single read
+            self.cache_misses += 1
+            self.loading[key] = [(version, seg_no, seg_size)]
+            aio.get_event_loop().call_soon(self.load_payload, key)
+
+    def load_payload(self, key: typing.Tuple[bytes, str, typing.Optional[bytes]]):
+        obj_name, form, want = key
         try:
-            obj_type, data = self.repo.read_obj(bytes(obj_name))
+            if form == BATCH_FORM:
+                payload = self.read_batch(obj_name, want)
+            else:
+                payload = self.read_payload(obj_name, form == ZLIB_FORM)
         except ValueError:
-            logging.warning(f'Requested file {obj_name} does not exist in repo {self.repo.repo_name}')
+            logging.warning(f'Requested file {obj_name.hex()} does not exist in repo {self.repo.repo_name}')
+            return
+        finally:
+            requests = self.loading.pop(key)
+        self.serve_cache.put(key, payload)
+        for version, seg_no, seg_size in requests:
+            self.put_segment(obj_name, payload, version, seg_no, seg_size)
+
+    def put_segment(self, obj_name: bytes, payload: Payload, version: typing.Optional[int], seg_no: int,
+                    seg_size: int = SEGMENTATION_SIZE):
+        if payload.version is not None and version is not None and version != payload.version:
             return
+        wire = self.sign_segment(obj_name, payload, seg_no, seg_size)
+        if wire is not None:
+            self.app.put_raw_packet(wire)
+            logging.debug(f'Responded {obj_name.hex()} segment {seg_no} in repo {self.repo.repo_name}')
+
+    def sign_segment(self, obj_name: bytes, payload: Payload, seg_no: int, seg_size: int) -> typing.Optional[bytes]:
         # Extract the segment and calculate Name
-        data_name = self.prefix + [Component.from_bytes(obj_name), Component.from_segment(seg_no)]
-        start_pos = seg_no * SEGMENTATION_SIZE
-        data_seg = data[start_pos:start_pos + SEGMENTATION_SIZE]
-        packet_obj = SyncObject()
-        packet_obj.obj_type = obj_type.encode()
-        packet_obj.obj_data = data_seg
-        wire = packet_obj.encode()
-        final_block = (len(data) + SEGMENTATION_SIZE - 1) // SEGMENTATION_SIZE
-        self.app.put_data(data_name, wire,
-                          freshness_period=3600000,
-                          final_block_id=Component.from_segment(final_block))
-        logging.debug(f'Responded {obj_name} segment {final_block} in repo {self.repo.repo_name}')
+        if payload.obj_type == BATCH_FORM:
+            form = BATCH_FORM
+            data_name = (self.prefix + [Component.from_bytes(obj_name), BATCH_COMPONENT]
+                         + batch_want_component(payload.want) + segment_size_component(seg_size)
+                         + [Component.from_segment(seg_no)])
+        elif payload.version is not None:
+            form = ZLIB_FORM
+            data_name = (self.prefix + [Component.from_bytes(obj_name), ZLIB_COMPONENT]
+                         + segment_size_component(seg_size)
+                         + [Component.from_version(payload.version), Component.from_segment(seg_no)])
+        else:
+            form = RAW_FORM
+            data_name = (self.prefix + [Component.from_bytes(obj_name)] + segment_size_component(seg_size)
+                         + [Component.from_segment(seg_no)])
+        wire_key = (obj_name, form, payload.want, seg_size, payload.version, seg_no)
+        wire = self.wires.get(wire_key)
+        if wire is not None:
+            return wire
+        start_pos = seg_no * seg_size
+        if payload.data is not None:
+            data_seg = payload.data[start_pos:start_pos + seg_size]
+        else:
+            try:
+                if payload.compressed:
+                    data_seg = self.repo.read_loose_range(obj_name, start_pos, seg_size)
+                else:
+                    data_seg = self.repo.read_obj_range(obj_name, start_pos, seg_size)
+            except (ValueError, OSError) as e:
+                logging.warning(f'Unable to read {obj_name.hex()} in repo {self.repo.repo_name} - {e}')
+                self.serve_cache.pop((obj_name, form, payload.want))
+                return None
+        if form == BATCH_FORM:
+            content = data_seg
+        else:
+            packet_obj = SyncObject()
+            packet_obj.obj_type = payload.obj_type.encode()
+            packet_obj.obj_data = data_seg
+            packet_obj.compressed = payload.compressed
+            if not payload.compressed:
+                packet_obj.obj_size = payload.size
+            content = packet_obj.encode()
+        final_block = max(payload.size - 1, 0) // seg_size
+        wire = self.app.prepare_data(data_name, content,
+                                     freshness_period=3600000,
+                                     final_block_id=Component.from_segment(final_block),
+                                     signer=self.signer)
+        # Content is named by its hash, so the signed packet can be sent again as it is
+        self.wires.put(wire_key, wire)
+        return wire
+
+    async def prewarm(self, head: bytes):
+        # Sign the segments of objects reachable from a new head before they are requested,
+        # in the form consumers ask for by default
+        seg_size = configured_segment_size()
+        queue = collections.deque([head])
+        seen = {head}
+        count = 0
+        while queue and count < self.prewarm_limit:
+            obj_name = queue.popleft()
+            key = (obj_name, ZLIB_FORM, None)
+            try:
+                payload = self.serve_cache.get(key)
+                if payload is None:
+                    payload = self.read_payload(obj_name, True)
+                    self.serve_cache.put(key, payload)
+                if payload.obj_type in ('commit', 'tree'):
+                    children = self.list_children(payload.obj_type, self.repo.read_obj(obj_name)[1])
+                else:
+                    children = []
+            except (ValueError, KeyError):
+                continue
+            for seg_no in range(max(payload.size - 1, 0) // seg_size + 1):
+                self.sign_segment(obj_name, payload, seg_no, seg_size)
+            for _, child_name in children:
+                if child_name not in seen:
+                    seen.add(child_name)
+                    queue.append(child_name)
+            count += 1
+            # Let Interests be served in between
+            await aio.sleep(0)
+        logging.info(f'Prewarmed {count} objects from {head.hex()} in repo {self.repo.repo_name}')
+
+    def read_batch(self, tree_name: bytes, want: typing.Optional[bytes] = None) -> Payload:
+        # Throws: ValueError
+        # Children of the tree up to BATCH_OBJECT_LIMIT, while the batch is within BATCH_SIZE_LIMIT.
+        # want is a bitmap of the children to include, by their positions in the tree.
+        obj_type, _ = self.repo.obj_info(tree_name)
+        if obj_type != 'tree':
+            raise ValueError(f'{tree_name.hex()} is not a tree')
+        _, content = self.repo.read_obj(tree_name)
+        batch = ObjectBatch()
+        batch.objects = []
+        total = 0
+        for i, (child_type, child_name) in enumerate(self.traverse_tree(content)):
+            if want is not None and (i // 8 >= len(want) or not want[i // 8] & (0x80 >> (i % 8))):
+                continue
+            try:
+                obj_type, size = self.repo.obj_info(child_name)
+            except ValueError:
+                continue
+            if size > BATCH_OBJECT_LIMIT or total + size > BATCH_SIZE_LIMIT:
+                continue
+            obj = BatchObject()
+            obj.obj_name = child_name
+            obj.obj_type = obj_type.encode()
+            _, obj.obj_data = self.repo.read_obj(child_name)
+            batch.objects.append(obj)
+            total += size
+        wire = batch.encode()
+        return Payload(BATCH_FORM, wire, len(wire), False, None, want)
+
+    def read_payload(self, obj_name: bytes, compressed: bool) -> Payload:
+        # Throws: ValueError
+        # Raw data is the same on every producer, so it has version 0 under zlib names.
+        # Compressed data differs between producers, so the version is its CRC-32.
+        raw_version = 0 if compressed else None
+        obj_type, size = self.repo.obj_info(obj_name)
+        if size > STREAM_THRESHOLD:
+            # Big objects are never held in memory as a whole
+            if compressed:
+                loose = self.repo.loose_obj_crc32(obj_name)
+                if loose is not None:
+                    loose_size, crc = loose
+                    return Payload(obj_type, None, loose_size, True, crc)
+            return Payload(obj_type, None, size, False, raw_version)
+        if compressed:
+            # A loose object is sent as it is on the disk
+            loose = self.repo.read_loose_obj(obj_name)
+            if loose is not None:
+                return Payload(obj_type, loose, len(loose), True, zlib.crc32(loose))
+        _, data = self.repo.read_obj(obj_name)
+        if compressed:
+            deflated = zlib.compress(obj_type.encode() + b' ' + f'{len(data)}'.encode() + b'\x00' + data)
+            if len(deflated) < len(data):
+                return Payload(obj_type, deflated, len(deflated), True, zlib.crc32(deflated))
+        return Payload(obj_type, data, len(data), False, raw_version)
@@ -0,0 +1,79 @@
+import os
+import typing
+import logging
+import tempfile
+
+
+JOURNAL_FILE = 'ndn-fetch-journal'
+COMPACT_THRESHOLD = 4096
+
+
+class FetchJournal:
+    # Append-only log of incomplete objects, so that an interrupted fetch can be resumed.
+    # "+<sha> <type>" marks an object incomplete, "-<sha>" marks it complete.
+    # An object is logged before it is stored, and removed after everything it refers to is complete.
+    def __init__(self, git_dir: str):
+        self.path = os.path.join(git_dir, JOURNAL_FILE)
+        self.file = None
+        self.lines = 0
+
+    def load(self) -> typing.Dict[bytes, str]:
+        entries = {}
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    # A line cut by a crash is ignored
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        if line[0] == '+':
+                            hex_name, _, obj_type = line[1:-1].partition(' ')
+                            entries[bytes.fromhex(hex_name)] = obj_type
+                        elif line[0] == '-':
+                            entries.pop(bytes.fromhex(line[1:-1]), None)
+                    except ValueError:
+                        logging.warning(f'Invalid line in fetch journal {self.path}')
+        except FileNotFoundError:
+            pass
+        if entries:
+            logging.info(f'Resuming {len(entries)} incomplete objects from {self.path}')
+        self.compact(entries)
+        return entries
+
+    def append(self, added: typing.Iterable[typing.Tuple[str, bytes]], removed: typing.Iterable[bytes] = ()):
+        lines = [f'+{obj_name.hex()} {obj_type}\n' for obj_type, obj_name in added]
+        lines.extend(f'-{obj_name.hex()}\n' for obj_name in removed)
+        if not lines:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(''.join(lines))
+        # Flushed before the objects are stored, so it survives a crash of the process
+        self.file.flush()
+        self.lines += len(lines)
+
+    def compact(self, entries: typing.Dict[bytes, str]):
+        # Rewrite the journal with live entries only
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if not entries:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.lines = 0
+            return
+        fd, tmp_path = tempfile.mkstemp(prefix='tmp_journal_', dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join(f'+{obj_name.hex()} {obj_type}\n' for obj_name, obj_type in entries.items()))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.lines = len(entries)
+
+    def maybe_compact(self, entries: typing.Dict[bytes, str]):
+        if self.lines > max(COMPACT_THRESHOLD, 4 * len(entries)):
+            self.compact(entries)
@@ -1,56 +1,88 @@
 import typing
+import hashlib
 from git import Commit
 from ..repos import GitRepo
 
 HASH_LENGTH = 20
+TREE_MODE = b'40000'
+
+# (mode, sha) of a tree entry, None if it does not exist
+Entry = typing.Optional[typing.Tuple[bytes, bytes]]
+
+
+class MergeReport:
+    # Result of a three-way merge of trees: the conflicting paths with a reason,
+    # or the merged tree and the contents of the new trees it needs, children first.
+    def __init__(self):
+        self.conflicts = []
+        self.trees = []
+        self.tree_sha = None
+
+    @property
+    def mergeable(self) -> bool:
+        return not self.conflicts
 
 
 class Merger:
     def __init__(self, repo: GitRepo):
         self.repo = repo
 
-    def merge_step(self, base_sha: typing.Optional[bytes], ori_sha: bytes, new_sha: bytes) -> bytes:
+    def merge_trees(self, base_sha: bytes, ori_sha: bytes, new_sha: bytes) -> MergeReport:
+        # Walk base, original and new together, only descending into subtrees that differ on both sides.
+        # Deletion is not supported, and a file can only be changed on one side.
+        report = MergeReport()
+        merged = self.merge_entry(report, b'', (TREE_MODE, base_sha), (TREE_MODE, ori_sha), (TREE_MODE, new_sha))
+        report.tree_sha = merged[1]
+        return report
+
+    def merge_entry(self, report: MergeReport, path: bytes, base: Entry, ori: Entry, new: Entry) -> Entry:
         # If only one side changes it, pick that one
-        if ori_sha == new_sha:
-            return ori_sha
-        elif base_sha is not None:
-            if ori_sha == base_sha:
-                return new_sha
-            elif new_sha == base_sha:
-                return ori_sha
+        if ori == new:
+            self.check_deletions(report, path, base, ori)
+            return ori
+        elif ori == base:
+            self.check_deletions(report, path, base, new)
+            return new
+        elif new == base:
+            self.check_deletions(report, path, base, ori)
+            return ori
+        elif base is not None and (ori is None or new is None):
+            report.conflicts.append((path.decode(), 'deleted'))
+            return ori or new
         # Otherwise, this must be a tree (because file merge is not supported yet)
-        ori_type, ori_tree = self.repo.read_obj(ori_sha)
-        new_type, new_tree = self.repo.read_obj(new_sha)
-        if any(True for t in [ori_type, new_type] if t != 'tree'):
-            raise ValueError('Merge conflict')
-        if base_sha:
-            _, base_tree = self.repo.read_obj(base_sha)
-            base_dict = self.parse_tree(base_tree)
-        else:
-            base_dict = {}
-        ori_dict = self.parse_tree(ori_tree)
-        new_dict = self.parse_tree(new_tree)
-        # We may assume that either original or new agrees with base on any file
-        # Recursively merge
+        if ori[0] != TREE_MODE or new[0] != TREE_MODE:
+            report.conflicts.append((path.decode(), 'changed on both sides'))
+            return ori
+        base_dict = self.read_tree(base[1]) if base is not None and base[0] == TREE_MODE else {}
+        ori_dict = self.read_tree(ori[1])
+        new_dict = self.read_tree(new[1])
         ret_dict = {}
-        common_items = ori_dict.keys() & new_dict.keys()
-        for bname in common_items:
-            otype, osha = ori_dict[bname]
-            ntype, nsha = new_dict[bname]
-            if otype != ntype:
-                raise ValueError('Merge conflict')
-            bsha = base_dict[bname] if bname in base_dict else None
-            ret_dict[bname] = (otype, self.merge_step(bsha, osha, nsha))
-        # Add new files (Note: deletion is noe supported here)
-        for oname, (otype, osha) in ori_dict.items():
-            if oname not in ret_dict:
-                ret_dict[oname] = (otype, osha)
-        for nname, (ntype, nsha) in new_dict.items():
-            if nname not in ret_dict:
-                ret_dict[nname] = (ntype, nsha)
-        # Create the tree object and write it
-        ret_content = self.encode_tree(ret_dict)
-        return self.repo.store_obj(b'tree', ret_content)
+        for name in ori_dict.keys() | new_dict.keys() | base_dict.keys():
+            entry = self.merge_entry(report, path + b'/' + name if path else name,
+                                     base_dict.get(name), ori_dict.get(name), new_dict.get(name))
+            if entry is not None:
+                ret_dict[name] = entry
+        content = self.encode_tree(ret_dict)
+        report.trees.append(content)
+        return TREE_MODE, hashlib.sha1(b'tree %d\x00' % len(content) + content).digest()
+
+    def check_deletions(self, report: MergeReport, path: bytes, base: Entry, side: Entry):
+        # Files of base missing on one side, looking only into subtrees that differ
+        if base is None or base == side:
+            return
+        if side is None or (base[0] == TREE_MODE) != (side[0] == TREE_MODE):
+            report.conflicts.append((path.decode(), 'deleted'))
+        elif base[0] == TREE_MODE:
+            base_dict = self.read_tree(base[1])
+            side_dict = self.read_tree(side[1])
+            for name, entry in base_dict.items():
+                self.check_deletions(report, path + b'/' + name if path else name, entry, side_dict.get(name))
+
+    def read_tree(self, tree_sha: bytes) -> typing.Dict[bytes, typing.Tuple[bytes, bytes]]:
+        obj_type, content = self.repo.read_obj(tree_sha)
+        if obj_type != 'tree':
+            raise ValueError(f'{tree_sha.hex()} is not a tree')
+        return self.parse_tree(content)
 
     @staticmethod
     def parse_tree(content: bytes):
@@ -77,8 +109,16 @@ class Merger:
         )
         return ret
 
-    def create_commit(self, base: Commit, lhs: Commit, rhs: Commit) -> bytes:
-        ret_tree = self.merge_step(base.tree.binsha, lhs.tree.binsha, rhs.tree.binsha)
+    def create_commit(self, base: Commit, lhs: Commit, rhs: Commit,
+                      report: typing.Optional[MergeReport] = None) -> bytes:
+        # Throws: ValueError
+        if report is None:
+            report = self.merge_trees(base.tree.binsha, lhs.tree.binsha, rhs.tree.binsha)
+        if not report.mergeable:
+            raise ValueError(f'Merge conflict {report.conflicts}')
+        for content in report.trees:
+            self.repo.store_obj(b'tree', content)
+        ret_tree = report.tree_sha
         ret = ''
         ret += f'tree {ret_tree.hex()}\n'
         ret += f'parent {lhs.hexsha}\n'
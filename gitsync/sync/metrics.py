@@ -0,0 +1,137 @@
+import time
+import typing
+import bisect
+import collections
+
+
+# Upper bounds of histogram buckets
+LATENCY_BUCKETS = (5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2500.0, 5000.0, 10000.0)
+SEGMENT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 1024, 4096)
+
+
+class Histogram:
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'buckets': dict(zip([*self.buckets, float('inf')], self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class FetchMetrics:
+    # Counters of an ObjectFetcher, to tell a network-bound sync from a disk-bound one.
+    # Times are in milliseconds, except the *_seconds totals.
+    def __init__(self):
+        self.objects = collections.Counter()
+        self.filtered = 0
+        self.batches = 0
+        self.bytes_received = 0
+        self.segments = Histogram(SEGMENT_BUCKETS)
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.interests = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        self.nacks = 0
+        # Refs in sync updates, and those equal to the local head
+        self.refs_received = 0
+        self.refs_skipped = 0
+        self.hash_seconds = 0.0
+        self.store_seconds = 0.0
+        # Wall time with at least one fetch running, for the throughput
+        self.busy_seconds = 0.0
+        self.running = 0
+        self.busy_since = 0.0
+
+    def fetch_started(self):
+        if self.running == 0:
+            self.busy_since = time.monotonic()
+        self.running += 1
+
+    def fetch_stopped(self):
+        self.running -= 1
+        if self.running == 0:
+            self.busy_seconds += time.monotonic() - self.busy_since
+
+    def object_fetched(self, obj_type: str, size: int, segments: int, latency: float):
+        self.objects[obj_type] += 1
+        self.bytes_received += size
+        self.segments.observe(segments)
+        self.latency.observe(latency)
+
+    def throughput(self) -> float:
+        busy = self.busy_seconds
+        if self.running > 0:
+            busy += time.monotonic() - self.busy_since
+        return self.bytes_received / busy if busy > 0 else 0.0
+
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'objects': dict(self.objects),
+            'objects_filtered': self.filtered,
+            'batches': self.batches,
+            'bytes_received': self.bytes_received,
+            'segments_per_object': self.segments.snapshot(),
+            'object_latency_ms': self.latency.snapshot(),
+            'interests': self.interests,
+            'retransmits': self.retransmits,
+            'timeouts': self.timeouts,
+            'nacks': self.nacks,
+            'refs_received': self.refs_received,
+            'refs_skipped': self.refs_skipped,
+            'hash_seconds': self.hash_seconds,
+            'store_seconds': self.store_seconds,
+            'busy_seconds': self.busy_seconds,
+            'throughput_bytes_per_second': self.throughput(),
+        }
+
+
+def export_text(metrics: typing.Dict[str, FetchMetrics],
+                stats: typing.Optional[typing.Dict[str, typing.Dict[str, float]]] = None) -> str:
+    # Prometheus text format, labeled by repo. stats holds other values of each repo by metric name.
+    lines = []
+
+    def add(name: str, value: float, labels: typing.Dict[str, str]):
+        label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+        lines.append(f'gitsync_fetch_{name}{{{label_str}}} {value}')
+
+    def add_histogram(name: str, hist: Histogram, labels: typing.Dict[str, str]):
+        total = 0
+        for bound, count in zip([*hist.buckets, '+Inf'], hist.counts):
+            total += count
+            add(f'{name}_bucket', total, {**labels, 'le': str(bound)})
+        add(f'{name}_sum', hist.sum, labels)
+        add(f'{name}_count', hist.count, labels)
+
+    for repo_name, m in metrics.items():
+        labels = {'repo': repo_name}
+        for obj_type, count in m.objects.items():
+            add('objects_total', count, {**labels, 'type': obj_type})
+        add('objects_filtered_total', m.filtered, labels)
+        add('batches_total', m.batches, labels)
+        add('bytes_received_total', m.bytes_received, labels)
+        add_histogram('segments_per_object', m.segments, labels)
+        add_histogram('object_latency_ms', m.latency, labels)
+        add('interests_total', m.interests, labels)
+        add('retransmits_total', m.retransmits, labels)
+        add('timeouts_total', m.timeouts, labels)
+        add('nacks_total', m.nacks, labels)
+        add('refs_received_total', m.refs_received, labels)
+        add('refs_skipped_total', m.refs_skipped, labels)
+        add('hash_seconds_total', m.hash_seconds, labels)
+        add('store_seconds_total', m.store_seconds, labels)
+        add('busy_seconds_total', m.busy_seconds, labels)
+        add('throughput_bytes_per_second', m.throughput(), labels)
+        for name, value in (stats or {}).get(repo_name, {}).items():
+            add(name, value, labels)
+    return ''.join(line + '\n' for line in lines)
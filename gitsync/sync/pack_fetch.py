@@ -0,0 +1,199 @@
+import typing
+import logging
+import hashlib
+import asyncio as aio
+from git import GitCommandError
+from ndn.app import NDNApp
+from ndn.encoding import Component, FormalName, InterestParam, BinaryStr, DecodeError, Signer, ContentType
+from ndn.types import InterestTimeout, InterestNack
+from ..repos import start_git
+from .cache import LruCache
+from .fetch_queue import (SEGMENTATION_SIZE, SegmentWindow, windowed_segment_fetcher, segment_size_component,
+                          parse_segment_size)
+from .packet import PackRequest, PackInfo
+
+
+PACK_CACHE_SIZE = 256 * 1024 * 1024
+PACK_REQUEST_CACHE_SIZE = 4096
+PACK_LIFETIME = 4000
+# The producer keeps building a pack between Interests, so a request is retried meanwhile
+PACK_RETRY_TIMES = 3
+# A clone has nothing better to fetch by, so it waits up to a minute
+CLONE_RETRY_TIMES = 15
+PACK_MAX_FAILURES = 3
+MAX_HAVES = 64
+# Missing commits behind a head for a sync to fetch a pack instead of objects one by one
+PACK_MIN_GAP = 16
+
+
+class PackFetcher:
+    # Bulk transfer of a git packfile for everything reachable from wants but not from haves.
+    # A request /pack/<params-digest> is answered with a PackInfo, naming the pack by its SHA-256.
+    # The pack itself is served as /pack/<sha-256>/<seg>, which is immutable and can be cached by the network.
+    # A request the producer cannot serve is answered with an application Nack.
+    def __init__(self, app: NDNApp, repo, prefix: FormalName, signer: typing.Optional[Signer] = None):
+        self.app = app
+        self.repo = repo
+        self.prefix = prefix
+        # The pack is checked against its SHA-256, so segments may use a cheaper signer than PackInfo
+        self.signer = signer
+        self.window = SegmentWindow()
+        self.packs = LruCache(PACK_CACHE_SIZE)
+        self.pack_names = LruCache(PACK_REQUEST_CACHE_SIZE, size_of=lambda _: 1)
+        self.building = {}
+        # Packs are not requested after consecutive failures, e.g. with a producer not serving them
+        self.supported = False
+        self.probing = False
+        self.failures = 0
+        aio.create_task(self.app.register(self.prefix, self.on_interest))
+
+    def close(self):
+        self.app.unregister(self.prefix)
+
+    def use_pack(self) -> bool:
+        # Until a request is answered, one request at a time probes whether the producer serves packs
+        if self.failures >= PACK_MAX_FAILURES:
+            return False
+        if self.supported:
+            return True
+        if self.probing:
+            return False
+        self.probing = True
+        return True
+
+    async def fetch(self, wants: typing.List[bytes], haves: typing.List[bytes],
+                    retry_times: typing.Optional[int] = None) -> bool:
+        # Throws: ValueError if the producer has no pack for the request
+        req = PackRequest()
+        req.wants = wants
+        req.haves = haves[:MAX_HAVES]
+        if retry_times is None:
+            retry_times = PACK_RETRY_TIMES if self.supported else 1
+        trial_times = 0
+        try:
+            while True:
+                try:
+                    _, meta, content = await self.app.express_interest(self.prefix, app_param=req.encode(),
+                                                                       must_be_fresh=True, lifetime=PACK_LIFETIME)
+                    break
+                except InterestTimeout:
+                    trial_times += 1
+                    if trial_times >= retry_times:
+                        raise
+        except (InterestTimeout, InterestNack):
+            self.failures += 1
+            raise
+        finally:
+            self.probing = False
+        self.supported = True
+        self.failures = 0
+        if meta.content_type == ContentType.NACK:
+            raise ValueError(f'No pack for {", ".join(want.hex() for want in wants)}')
+        info = PackInfo.parse(content)
+        pack_name = bytes(info.pack_name)
+        logging.info(f'Fetching pack {pack_name.hex()} of {info.pack_size} bytes for repo {self.repo.repo_name}')
+        # Stream the pack into git, holding back the last segment until the digest is checked
+        proc = await start_git(self.repo.git_dir, 'index-pack', '--stdin', '--fix-thin')
+        h = hashlib.sha256()
+        last = b''
+        try:
+            pack_prefix = (self.prefix + [Component.from_bytes(pack_name)]
+                           + segment_size_component(self.window.segment_size))
+            async for seg in windowed_segment_fetcher(self.app, pack_prefix, self.window, must_be_fresh=False):
+                proc.stdin.write(last)
+                await proc.stdin.drain()
+                last = bytes(seg)
+                h.update(last)
+            if h.digest() != pack_name:
+                raise ValueError(f'Pack {pack_name.hex()} has a different digest')
+            _, stderr = await proc.communicate(last)
+            if proc.returncode != 0:
+                raise GitCommandError(['git', 'index-pack'], proc.returncode, stderr)
+            self.repo.obj_index.reload_packs()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        return True
+
+    def on_interest(self, name: FormalName, _param: InterestParam, app_param: typing.Optional[BinaryStr]):
+        if app_param is not None:
+            aio.create_task(self.answer_request(name, app_param))
+            return
+        # Get the name and segment number: <prefix>/<sha-256>[/size-<n>][/<seg>]
+        rest = name[len(self.prefix):]
+        seg_no = 0
+        if rest and Component.get_type(rest[-1]) == Component.TYPE_SEGMENT:
+            seg_no = Component.to_number(rest[-1])
+            rest = rest[:-1]
+        if not rest:
+            return
+        pack_name = bytes(Component.get_value(rest[0]))
+        seg_size = SEGMENTATION_SIZE
+        if len(rest) > 1:
+            seg_size = parse_segment_size(rest[1])
+            if seg_size is None:
+                return
+        pack = self.packs.get(pack_name)
+        if pack is None:
+            logging.warning(f'Requested pack {pack_name.hex()} is not cached in repo {self.repo.repo_name}')
+            return
+        data_name = (self.prefix + [Component.from_bytes(pack_name)] + segment_size_component(seg_size)
+                     + [Component.from_segment(seg_no)])
+        start_pos = seg_no * seg_size
+        final_block = max(len(pack) - 1, 0) // seg_size
+        self.app.put_data(data_name, pack[start_pos:start_pos + seg_size],
+                          freshness_period=3600000,
+                          final_block_id=Component.from_segment(final_block),
+                          signer=self.signer)
+
+    async def answer_request(self, name: FormalName, app_param: BinaryStr):
+        try:
+            req = PackRequest.parse(app_param)
+        except (DecodeError, IndexError) as e:
+            logging.warning(f'Invalid pack request - {e}')
+            self.reject(name)
+            return
+        wants = sorted(bytes(want) for want in req.wants or [])
+        if not wants or not all(self.repo.has_obj(want) for want in wants):
+            logging.warning(f'Requested pack contains unknown commits in repo {self.repo.repo_name}')
+            self.reject(name)
+            return
+        # Unknown haves cannot be used as the base of the pack
+        haves = sorted(bytes(have) for have in req.haves or [] if self.repo.has_obj(bytes(have)))
+        key = (tuple(wants), tuple(haves))
+        pack_name = self.pack_names.get(key)
+        if pack_name is None or pack_name not in self.packs:
+            if key not in self.building:
+                self.building[key] = aio.create_task(self.build_pack(key))
+            try:
+                pack_name = await aio.shield(self.building[key])
+            except (GitCommandError, ValueError) as e:
+                logging.warning(f'Unable to build pack - {e}')
+                self.reject(name)
+                return
+        pack = self.packs.get(pack_name)
+        if pack is None:
+            self.reject(name)
+            return
+        info = PackInfo()
+        info.pack_name = pack_name
+        info.pack_size = len(pack)
+        self.app.put_data(name, info.encode(), freshness_period=1000)
+
+    def reject(self, name: FormalName):
+        # So that the consumer falls back to fetching objects without waiting for a timeout
+        self.app.put_data(name, b'', content_type=ContentType.NACK, freshness_period=1000)
+
+    async def build_pack(self, key: typing.Tuple[typing.Tuple[bytes, ...], typing.Tuple[bytes, ...]]) -> bytes:
+        try:
+            wants, haves = key
+            pack = await self.repo.pack_objects(list(wants), list(haves))
+            pack_name = hashlib.sha256(pack).digest()
+            if not self.packs.put(pack_name, pack):
+                raise ValueError(f'Pack of {len(pack)} bytes is too large to be cached')
+            self.pack_names.put(key, pack_name)
+            logging.info(f'Built pack {pack_name.hex()} of {len(pack)} bytes in repo {self.repo.repo_name}')
+            return pack_name
+        finally:
+            del self.building[key]
@@ -4,6 +4,10 @@ from ndn import encoding as enc
 class SyncObject(enc.TlvModel):
     obj_type = enc.BytesField(0x01)
     obj_data = enc.BytesField(0x02)
+    # obj_data is a segment of the zlib-deflated loose object, including its header
+    compressed = enc.BoolField(0x0e)
+    # Size of the uncompressed object, so that the receiver can hash it as it arrives
+    obj_size = enc.UintField(0x0f)
 
 
 class RefInfo(enc.TlvModel):
@@ -24,3 +28,23 @@ class AddUserReq(enc.TlvModel):
     full_name = enc.BytesField(0x07)
     email = enc.BytesField(0x08)
     cert = enc.BytesField(0x09)
+
+
+class PackRequest(enc.TlvModel):
+    wants = enc.RepeatedField(enc.BytesField(0x0a))
+    haves = enc.RepeatedField(enc.BytesField(0x0b))
+
+
+class PackInfo(enc.TlvModel):
+    pack_name = enc.BytesField(0x0c)
+    pack_size = enc.UintField(0x0d)
+
+
+class BatchObject(enc.TlvModel):
+    obj_name = enc.BytesField(0x11)
+    obj_type = enc.BytesField(0x01)
+    obj_data = enc.BytesField(0x02)
+
+
+class ObjectBatch(enc.TlvModel):
+    objects = enc.RepeatedField(enc.ModelField(0x10, BatchObject))
@@ -0,0 +1,30 @@
+import os
+import typing
+import logging
+from ndn.encoding import Name, Signer
+from ndn.security import DigestSha256Signer, HmacSha256Signer
+
+
+KEY_POLICY = 'key'
+DIGEST_POLICY = 'digest'
+HMAC_POLICY = 'hmac'
+
+
+def object_signer(policy: typing.Optional[str] = None) -> typing.Optional[Signer]:
+    # Signer of object and pack segments. Their names carry the hash of the content,
+    # which the consumer checks anyway, so a digest or a shared HMAC is enough.
+    # None keeps the default key of the app, used for everything else.
+    if policy is None:
+        policy = os.getenv('GIT_NDN_OBJECT_SIGNING', KEY_POLICY)
+    policy = policy.lower()
+    if policy == DIGEST_POLICY:
+        return DigestSha256Signer()
+    elif policy == HMAC_POLICY:
+        key = os.getenv('GIT_NDN_OBJECT_HMAC_KEY')
+        if not key:
+            raise ValueError('GIT_NDN_OBJECT_HMAC_KEY is required by the hmac signing policy')
+        key_name = os.getenv('GIT_NDN_OBJECT_HMAC_NAME', os.getenv('GIT_NDN_PREFIX', '') + '/objects/KEY/hmac')
+        return HmacSha256Signer(Name.from_str(key_name), bytes.fromhex(key))
+    elif policy != KEY_POLICY:
+        logging.warning(f'Unknown object signing policy {policy}, using the default key')
+    return None
@@ -0,0 +1,96 @@
+import os
+import subprocess
+import pytest
+from gitsync.repos import GitRepos
+
+
+def git(git_dir, *args) -> str:
+    return subprocess.run(['git', '-C', git_dir, *args], check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.fixture
+def history(tmp_path):
+    # c0 - c1 - c2 - c3 ----- m - c5
+    #             \          /
+    #              b1 ---- b2
+    work = str(tmp_path / 'work')
+    os.makedirs(work)
+    git(work, 'init', '-q', '-b', 'main')
+    git(work, 'config', 'user.email', 'a@example.com')
+    git(work, 'config', 'user.name', 'a')
+    commits = {}
+    for name in ['c0', 'c1', 'c2']:
+        git(work, 'commit', '-q', '--allow-empty', '-m', name)
+        commits[name] = git(work, 'rev-parse', 'HEAD')
+    git(work, 'checkout', '-q', '-b', 'side')
+    for name in ['b1', 'b2']:
+        git(work, 'commit', '-q', '--allow-empty', '-m', name)
+        commits[name] = git(work, 'rev-parse', 'HEAD')
+    git(work, 'checkout', '-q', 'main')
+    git(work, 'commit', '-q', '--allow-empty', '-m', 'c3')
+    commits['c3'] = git(work, 'rev-parse', 'HEAD')
+    git(work, 'merge', '-q', '--no-ff', '--no-edit', 'side')
+    commits['m'] = git(work, 'rev-parse', 'HEAD')
+    git(work, 'commit', '-q', '--allow-empty', '-m', 'c5')
+    commits['c5'] = git(work, 'rev-parse', 'HEAD')
+    bare = tmp_path / 'repos'
+    os.makedirs(bare)
+    subprocess.run(['git', 'clone', '-q', '--bare', work, str(bare / 'src.git')], check=True)
+    return str(bare), {name: bytes.fromhex(sha) for name, sha in commits.items()}
+
+
+def test_ancestry(history):
+    base_dir, c = history
+    repo = GitRepos(base_dir)['src.git']
+    graph = repo.commit_graph
+    assert graph.generation(c['c0']) == 1
+    assert graph.generation(c['c5']) == 7
+    assert repo.is_ancestor(c['c0'], c['c5'])
+    assert repo.is_ancestor(c['b1'], c['m'])
+    assert not repo.is_ancestor(c['b1'], c['c3'])
+    assert not repo.is_ancestor(c['c5'], c['c0'])
+    assert repo.merge_base(c['c3'], c['b2']).binsha == c['c2']
+    assert repo.merge_base(c['c5'], c['b2']).binsha == c['b2']
+
+
+def test_list_commits(history):
+    base_dir, c = history
+    repo = GitRepos(base_dir)['src.git']
+    commits = [commit.binsha for commit in repo.list_commits(c['c2'], c['c5'])]
+    assert set(commits) == {c['c3'], c['b1'], c['b2'], c['m'], c['c5']}
+    # Parents come before their children
+    assert commits.index(c['b1']) < commits.index(c['b2']) < commits.index(c['m'])
+    assert commits.index(c['c3']) < commits.index(c['m']) < commits.index(c['c5'])
+    assert len(repo.list_commits(None, c['c5'])) == 8
+    assert repo.list_commits(c['c5'], c['c5']) == []
+
+
+def copy_commits(src_dir, repo, names):
+    for obj_name in names:
+        content = subprocess.run(['git', '-C', src_dir, 'cat-file', 'commit', obj_name.hex()],
+                                 check=True, capture_output=True).stdout
+        assert repo.store_obj(b'commit', content) == obj_name
+        yield obj_name, content
+
+
+@pytest.mark.parametrize('use_add', [True, False])
+def test_deepen(history, tmp_path, use_add):
+    # Commits stored after a query must not be hidden by generations cached while they were missing
+    base_dir, c = history
+    src_dir = os.path.join(base_dir, 'src.git')
+    dst_base = tmp_path / 'dst'
+    os.makedirs(dst_base)
+    git(str(dst_base), 'init', '-q', '--bare', 'dst.git')
+    repo = GitRepos(str(dst_base))['dst.git']
+    graph = repo.commit_graph
+    order = ['c5', 'm', 'c3', 'b2', 'b1', 'c2', 'c1', 'c0']
+    stored = 0
+    for depth in [2, 4, 8]:
+        for obj_name, content in copy_commits(src_dir, repo, [c[name] for name in order[stored:depth]]):
+            if use_add:
+                graph.add(obj_name, content)
+        stored = depth
+        assert len(repo.list_commits(None, c['c5'])) == depth
+    assert graph.generation(c['c5']) == 7
+    assert repo.is_ancestor(c['c0'], c['c5'])
+    assert repo.merge_base(c['c3'], c['b2']).binsha == c['c2']
@@ -0,0 +1,112 @@
+import os
+import subprocess
+import asyncio as aio
+import pytest
+from gitsync.repos import GitRepos
+from gitsync.sync import packet
+from gitsync.sync.fetch_pipeline import RepoSyncPipeline
+
+
+def git(git_dir, *args) -> str:
+    return subprocess.run(['git', '-C', git_dir, *args], check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    # Three commits in a line
+    work = str(tmp_path / 'work')
+    os.makedirs(work)
+    git(work, 'init', '-q', '-b', 'main')
+    git(work, 'config', 'user.email', 'a@example.com')
+    git(work, 'config', 'user.name', 'a')
+    commits = []
+    for name in ['c0', 'c1', 'c2']:
+        git(work, 'commit', '-q', '--allow-empty', '-m', name)
+        commits.append(bytes.fromhex(git(work, 'rev-parse', 'HEAD')))
+    base_dir = str(tmp_path / 'repos')
+    os.makedirs(base_dir)
+    subprocess.run(['git', 'clone', '-q', '--bare', work, os.path.join(base_dir, 'src.git')], check=True)
+    return GitRepos(base_dir)['src.git'], commits
+
+
+def encode_update(ref_updates):
+    update = packet.SyncUpdate()
+    update.ref_into = []
+    for name, head in ref_updates.items():
+        ref_info = packet.RefInfo()
+        ref_info.ref_name = name.encode()
+        ref_info.ref_head = head
+        update.ref_into.append(ref_info)
+    return update.encode()
+
+
+class Rounds:
+    # Records the rounds of a pipeline instead of fetching; a round lasts until the gate is opened
+    def __init__(self, pipeline):
+        self.rounds = []
+        self.gate = aio.Event()
+        pipeline.after_update = self.after_update
+
+    async def after_update(self, ref_updates, respond_to):
+        self.rounds.append((ref_updates, respond_to))
+        await self.gate.wait()
+
+
+def test_drain_updates(repo):
+    repo, c = repo
+    unknown = b'\xff' * 20
+
+    async def run():
+        pipeline = RepoSyncPipeline(None, repo, None)
+        rounds = Rounds(pipeline)
+        pipeline.on_update(encode_update({'refs/heads/main': c[1]}), b'r1')
+        await aio.sleep(0)
+        assert pipeline.in_process
+        # Updates during a round are merged by ref
+        pipeline.on_update(encode_update({'refs/heads/main': c[2], 'refs/heads/a': c[0]}), b'r2')
+        # An older head does not replace a newer one
+        pipeline.on_update(encode_update({'refs/heads/main': c[1]}), b'r3')
+        # Without both commits the latest wins
+        pipeline.on_update(encode_update({'refs/heads/a': unknown}), b'r4')
+        assert len(rounds.rounds) == 1
+        rounds.gate.set()
+        while pipeline.in_process:
+            await aio.sleep(0)
+        return rounds.rounds, pipeline
+
+    rounds, pipeline = aio.run(run())
+    assert rounds == [
+        ({'refs/heads/main': c[1]}, b'r1'),
+        ({'refs/heads/main': c[2], 'refs/heads/a': unknown}, b'r4'),
+    ]
+    assert pipeline.pending_updates == {}
+    assert pipeline.pending_respond_to is None
+
+
+def test_newer_head(repo):
+    repo, c = repo
+    pipeline = RepoSyncPipeline(None, repo, None)
+    pipeline.queue_update('refs/heads/main', c[1])
+    pipeline.queue_update('refs/heads/main', c[2])
+    assert pipeline.pending_updates == {'refs/heads/main': c[2]}
+    pipeline.queue_update('refs/heads/main', c[0])
+    assert pipeline.pending_updates == {'refs/heads/main': c[2]}
+
+
+def test_failed_round(repo):
+    repo, c = repo
+
+    async def after_update(_ref_updates, _respond_to):
+        raise RuntimeError
+
+    async def run():
+        pipeline = RepoSyncPipeline(None, repo, None)
+        pipeline.after_update = after_update
+        pipeline.in_process = True
+        pipeline.queue_update('refs/heads/main', c[2])
+        with pytest.raises(RuntimeError):
+            await pipeline.drain_updates()
+        # The next update starts a new round
+        assert not pipeline.in_process
+
+    aio.run(run())
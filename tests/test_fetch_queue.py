@@ -0,0 +1,367 @@
+import os
+import hashlib
+import subprocess
+import collections
+import asyncio as aio
+import pytest
+from ndn.encoding import Name, Component, InterestParam, MetaInfo, make_data, parse_data
+from ndn.security import DigestSha256Signer
+from ndn.types import InterestTimeout
+from gitsync.repos import GitRepos
+from gitsync.sync.fetch_queue import ObjectFetcher, SegmentWindow, windowed_segment_fetcher, \
+    INIT_CWND, INIT_RTO, MAX_RTO, LOSS_EPOCH, SEGMENT_SIZES
+from gitsync.sync.journal import FetchJournal, JOURNAL_FILE
+from gitsync.sync.metrics import FetchMetrics
+
+PREFIX = Name.from_str('/test/objects')
+# Lifetimes are shortened, so that a lost Interest times out in milliseconds
+TIME_SCALE = 0.1
+# Larger than a batch object and than a segment, and incompressible
+BIG = b''.join(hashlib.sha256(i.to_bytes(2, 'big')).digest() for i in range(1000))
+BIG_NAME = hashlib.sha1(b'blob ' + f'{len(BIG)}'.encode() + b'\x00' + BIG).digest()
+
+
+class FakeApp:
+    # In-process forwarder: an Interest goes to the first handler registered for its prefix,
+    # and Data put by the handler satisfies the pending Interests it matches.
+    def __init__(self):
+        self.routes = []
+        self.pending = []
+        self.sent = []
+        # Interests for which drop(name) is true are lost
+        self.drop = lambda name: False
+        # If set, Interests are held until the event is set
+        self.hold = None
+
+    async def register(self, name, func, **_kwargs):
+        self.routes.append((Name.normalize(name), func))
+        return True
+
+    def unregister(self, name):
+        name = Name.normalize(name)
+        self.routes = [(prefix, func) for prefix, func in self.routes if prefix != name]
+
+    def prepare_data(self, name, content=None, signer=None, **kwargs):
+        return make_data(name, MetaInfo.from_dict(kwargs), content, signer=signer or DigestSha256Signer())
+
+    def put_raw_packet(self, wire):
+        name, meta, content, _ = parse_data(wire, with_tl=True)
+        for item in list(self.pending):
+            interest_name, can_be_prefix, fut = item
+            if Name.is_prefix(interest_name, name) if can_be_prefix else interest_name == name:
+                self.pending.remove(item)
+                if not fut.done():
+                    fut.set_result((name, meta, content))
+
+    def put_data(self, name, content=None, **kwargs):
+        self.put_raw_packet(self.prepare_data(name, content, **kwargs))
+
+    async def express_interest(self, name, app_param=None, **kwargs):
+        if self.hold is not None:
+            await self.hold.wait()
+        name = Name.normalize(name)
+        self.sent.append(Name.to_str(name))
+        param = InterestParam(can_be_prefix=kwargs.get('can_be_prefix', False),
+                              must_be_fresh=kwargs.get('must_be_fresh', False),
+                              lifetime=kwargs.get('lifetime', 4000))
+        item = (name, param.can_be_prefix, aio.get_event_loop().create_future())
+        self.pending.append(item)
+        if not self.drop(name):
+            for prefix, func in self.routes:
+                if Name.is_prefix(prefix, name):
+                    aio.get_event_loop().call_soon(func, name, param, app_param)
+                    break
+        try:
+            return await aio.wait_for(item[2], param.lifetime / 1000 * TIME_SCALE)
+        except aio.TimeoutError:
+            raise InterestTimeout()
+        finally:
+            if item in self.pending:
+                self.pending.remove(item)
+
+
+def git(git_dir, *args) -> str:
+    return subprocess.run(['git', '-C', git_dir, *args], check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.fixture
+def src(tmp_path):
+    # Three commits sharing the big blob and a subtree, in a bare repo named src.git
+    work = str(tmp_path / 'work')
+    os.makedirs(os.path.join(work, 'dir'))
+    os.makedirs(os.path.join(work, 'same'))
+    git(work, 'init', '-q', '-b', 'main')
+    git(work, 'config', 'user.email', 'a@example.com')
+    git(work, 'config', 'user.name', 'a')
+    with open(os.path.join(work, 'big.bin'), 'wb') as f:
+        f.write(BIG)
+    for name in ['a.txt', 'b.txt']:
+        with open(os.path.join(work, 'same', name), 'w') as f:
+            f.write(f'{name}\n')
+    for i in range(3):
+        for j in range(4):
+            with open(os.path.join(work, 'dir', f'f{j}.txt'), 'w') as f:
+                f.write(f'commit {i} file {j}\n')
+        git(work, 'add', '-A')
+        git(work, 'commit', '-q', '-m', f'c{i}')
+    base_dir = str(tmp_path / 'src')
+    os.makedirs(base_dir)
+    subprocess.run(['git', 'clone', '-q', '--bare', work, os.path.join(base_dir, 'src.git')], check=True)
+    return base_dir, bytes.fromhex(git(work, 'rev-parse', 'HEAD'))
+
+
+@pytest.fixture
+def dst(tmp_path):
+    base_dir = str(tmp_path / 'dst')
+    os.makedirs(base_dir)
+    subprocess.run(['git', 'init', '-q', '--bare', os.path.join(base_dir, 'dst.git')], check=True)
+    return base_dir
+
+
+async def start(app, src_dir, dst_dir):
+    server = ObjectFetcher(app, GitRepos(src_dir)['src.git'], PREFIX)
+    # The producer registers first, so that Interests go to it rather than to the consumer
+    await aio.sleep(0)
+    client = ObjectFetcher(app, GitRepos(dst_dir)['dst.git'], PREFIX)
+    await aio.sleep(0)
+    return server, client
+
+
+def reachable(git_dir, head: bytes):
+    # Commits and their root trees
+    commits = git(git_dir, 'rev-list', head.hex()).split()
+    trees = [git(git_dir, 'rev-parse', f'{commit}^{{tree}}') for commit in commits]
+    return {bytes.fromhex(sha) for sha in commits + trees}
+
+
+def test_fetch(src, dst):
+    src_dir, head = src
+
+    async def run():
+        _, client = await start(FakeApp(), src_dir, dst)
+        assert await client.fetch('commit', head)
+        assert not client.incomplete_list
+        # Nothing to do the second time
+        assert not await client.fetch('commit', head)
+        return client
+
+    client = aio.run(run())
+    dst_git = os.path.join(dst, 'dst.git')
+    git(dst_git, 'fsck', '--connectivity-only', head.hex())
+    assert client.metrics.batches > 0
+    assert not os.path.exists(os.path.join(dst_git, JOURNAL_FILE))
+
+
+def test_interrupted(src, dst):
+    src_dir, head = src
+    dst_git = os.path.join(dst, 'dst.git')
+
+    async def interrupt():
+        app = FakeApp()
+        app.drop = lambda name: Component.from_bytes(BIG_NAME) in name
+        _, client = await start(app, src_dir, dst)
+        with pytest.raises(InterestTimeout):
+            await client.fetch('commit', head)
+        return dict(client.incomplete_list)
+
+    async def resume():
+        _, client = await start(FakeApp(), src_dir, dst)
+        # The journal is loaded by the next run
+        assert client.incomplete_list == incomplete
+        await client.resume()
+        return client.incomplete_list
+
+    incomplete = aio.run(interrupt())
+    # Every commit and root tree waits for the big blob; the rest is complete
+    assert set(incomplete) == reachable(os.path.join(src_dir, 'src.git'), head) | {BIG_NAME}
+    assert incomplete[head] == 'commit'
+    assert incomplete[BIG_NAME] == 'blob'
+    assert aio.run(resume()) == {}
+    git(dst_git, 'fsck', '--connectivity-only', head.hex())
+    assert not os.path.exists(os.path.join(dst_git, JOURNAL_FILE))
+
+
+def test_complete(dst):
+    commit, tree, blob1, blob2 = (bytes([i]) * 20 for i in range(4))
+
+    async def run():
+        client = ObjectFetcher(FakeApp(), GitRepos(dst)['dst.git'], PREFIX)
+        client.mark_incomplete([('commit', commit), ('tree', tree), ('blob', blob1), ('blob', blob2)])
+        waiting = {commit: 1, tree: 2}
+        parents = collections.defaultdict(list, {tree: [commit], blob1: [tree], blob2: [tree]})
+        client.complete(blob1, waiting, parents)
+        # The tree still waits for the other blob, and the commit for the tree
+        assert set(client.incomplete_list) == {commit, tree, blob2}
+        assert waiting == {commit: 1, tree: 1}
+        client.complete(blob2, waiting, parents)
+        assert client.incomplete_list == {}
+        assert waiting == {commit: 0, tree: 0}
+        assert not parents
+
+    aio.run(run())
+    assert FetchJournal(os.path.join(dst, 'dst.git')).load() == {}
+
+
+def test_cancel_shared(src, dst):
+    src_dir, head = src
+
+    async def run():
+        app = FakeApp()
+        _, client = await start(app, src_dir, dst)
+        app.hold = aio.Event()
+        first = aio.create_task(client.fetch('commit', head))
+        second = aio.create_task(client.fetch('commit', head))
+        await aio.sleep(0.01)
+        assert client.fetch_coalesced == 1
+        task = client.pending[(head, None)]
+        # The fetch is kept while another traversal waits for it
+        first.cancel()
+        await aio.sleep(0)
+        assert not task.done()
+        assert client.pending_users[(head, None)] == 1
+        app.hold.set()
+        assert await second
+        with pytest.raises(aio.CancelledError):
+            await first
+        assert not client.incomplete_list
+
+    aio.run(run())
+
+
+def test_cancel_all(src, dst):
+    src_dir, head = src
+
+    async def run():
+        app = FakeApp()
+        _, client = await start(app, src_dir, dst)
+        app.hold = aio.Event()
+        fetches = [aio.create_task(client.fetch('commit', head)) for _ in range(2)]
+        await aio.sleep(0.01)
+        task = client.pending[(head, None)]
+        for fetch in fetches:
+            fetch.cancel()
+        await aio.gather(*fetches, return_exceptions=True)
+        await aio.sleep(0)
+        # The last traversal leaving cancels the fetch, and the head is left to be resumed
+        assert task.cancelled()
+        assert not client.pending
+        assert client.incomplete_list == {head: 'commit'}
+
+    aio.run(run())
+
+
+def test_window():
+    window = SegmentWindow(max_segment_size=SEGMENT_SIZES[-1])
+    # Slow start
+    window.on_data(100.0)
+    assert window.cwnd == INIT_CWND + 1
+    assert (window.srtt, window.rttvar, window.rto) == (100.0, 50.0, 300.0)
+    # Karn's algorithm: no RTT sample from a retransmitted segment
+    window.on_data(None)
+    assert window.rto == 300.0
+    cwnd = window.cwnd
+    window.on_timeout()
+    assert window.cwnd == window.ssthresh == cwnd / 2
+    assert window.rto == 600.0
+    # A burst of losses within an RTT decreases the window once
+    window.on_timeout()
+    assert window.cwnd == cwnd / 2
+    assert window.rto == 1200.0
+    # Congestion avoidance
+    window.on_data(None)
+    assert window.cwnd == cwnd / 2 + 1 / (cwnd / 2)
+    for _ in range(10):
+        window.on_timeout()
+    assert window.rto == MAX_RTO
+
+
+def test_segment_size():
+    window = SegmentWindow(max_segment_size=SEGMENT_SIZES[-1])
+    # High loss steps the segment size down, once per epoch
+    for i in range(LOSS_EPOCH):
+        window.count_loss(i % 4 == 0)
+    assert window.segment_size == SEGMENT_SIZES[-2]
+    # Low loss steps it back up, but not over the maximum
+    for _ in range(2 * LOSS_EPOCH):
+        window.count_loss(False)
+    assert window.segment_size == SEGMENT_SIZES[-1]
+
+
+def test_acquire():
+    async def run():
+        window = SegmentWindow()
+        for _ in range(int(INIT_CWND)):
+            await window.acquire()
+        waiter = aio.create_task(window.acquire())
+        await aio.sleep(0)
+        assert not waiter.done()
+        window.release()
+        await aio.sleep(0)
+        assert waiter.done()
+        assert window.in_flight == int(INIT_CWND)
+
+    aio.run(run())
+
+
+async def serve_segments(app, prefix, data: bytes, seg_size: int):
+    segments = [data[i:i + seg_size] for i in range(0, len(data), seg_size)]
+
+    def on_interest(name, _param, _app_param):
+        seg_no = Component.to_number(name[-1]) if len(name) > len(prefix) else 0
+        app.put_data(prefix + [Component.from_segment(seg_no)], segments[seg_no],
+                     final_block_id=Component.from_segment(len(segments) - 1))
+
+    await app.register(prefix, on_interest)
+
+
+def seg_name(prefix, seg_no: int) -> str:
+    return Name.to_str(prefix + [Component.from_segment(seg_no)])
+
+
+def test_retransmission():
+    prefix = Name.from_str('/test/segments')
+    lost = {seg_name(prefix, 3), seg_name(prefix, 7)}
+
+    def drop(name):
+        # Only the first Interest of each is lost
+        if Name.to_str(name) in lost:
+            lost.remove(Name.to_str(name))
+            return True
+        return False
+
+    async def run():
+        app = FakeApp()
+        app.drop = drop
+        await serve_segments(app, prefix, BIG, 1000)
+        window = SegmentWindow()
+        metrics = FetchMetrics()
+        segments = [bytes(seg) async for seg in windowed_segment_fetcher(app, prefix, window, metrics=metrics)]
+        assert b''.join(segments) == BIG
+        assert (metrics.timeouts, metrics.retransmits) == (2, 2)
+        assert app.sent.count(seg_name(prefix, 3)) == 2
+        assert window.in_flight == 0
+        # Grown by the segments received and decreased by the losses
+        assert INIT_CWND < window.cwnd < len(segments)
+        assert window.rto > window.srtt
+
+    aio.run(run())
+
+
+def test_segment_lost():
+    prefix = Name.from_str('/test/segments')
+
+    async def run():
+        app = FakeApp()
+        app.drop = lambda name: Name.to_str(name) == seg_name(prefix, 5)
+        await serve_segments(app, prefix, BIG, 1000)
+        window = SegmentWindow()
+        window.rto = INIT_RTO / 10
+        with pytest.raises(InterestTimeout):
+            async for _ in windowed_segment_fetcher(app, prefix, window, retry_times=3):
+                pass
+        assert app.sent.count(seg_name(prefix, 5)) == 3
+        # Interests still in flight are canceled
+        await aio.sleep(0)
+        assert window.in_flight == 0
+
+    aio.run(run())
@@ -0,0 +1,93 @@
+import zlib
+import hashlib
+import subprocess
+import pytest
+from gitsync.repos import LooseObjectWriter, loose_obj_path
+from gitsync.sync.fetch_queue import ObjectIngest
+from gitsync.sync.metrics import FetchMetrics
+from gitsync.sync.packet import SyncObject
+
+CONTENT = bytes(range(256)) * 64
+OBJ = b'blob ' + f'{len(CONTENT)}'.encode() + b'\x00' + CONTENT
+OBJ_NAME = hashlib.sha1(OBJ).digest()
+
+
+@pytest.fixture
+def git_dir(tmp_path):
+    git_dir = str(tmp_path / 'repo.git')
+    subprocess.run(['git', 'init', '-q', '--bare', git_dir], check=True)
+    return git_dir
+
+
+def make_segments(data: bytes, seg_size: int, **kwargs):
+    ret = []
+    for i in range(0, len(data), seg_size):
+        pack = SyncObject()
+        pack.obj_type = b'blob'
+        pack.obj_data = data[i:i + seg_size]
+        for key, value in kwargs.items():
+            setattr(pack, key, value)
+        ret.append(bytes(pack.encode()))
+    return ret
+
+
+def ingest(git_dir, segments):
+    writer = LooseObjectWriter(git_dir)
+    obj_ingest = ObjectIngest('blob', OBJ_NAME, writer, FetchMetrics())
+    try:
+        for seg in segments:
+            obj_ingest.feed(seg)
+        obj_ingest.finish()
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit(OBJ_NAME)
+
+
+def read_back(git_dir) -> bytes:
+    return subprocess.run(['git', '-C', git_dir, 'cat-file', 'blob', OBJ_NAME.hex()],
+                          check=True, capture_output=True).stdout
+
+
+@pytest.mark.parametrize('compressed', [True, False])
+def test_ingest(git_dir, compressed):
+    if compressed:
+        segments = make_segments(zlib.compress(OBJ), 1000, compressed=True)
+    else:
+        segments = make_segments(CONTENT, 1000, obj_size=len(CONTENT))
+    ingest(git_dir, segments)
+    assert read_back(git_dir) == CONTENT
+
+
+def test_ingest_without_size(git_dir):
+    # Old producers send the content only
+    ingest(git_dir, make_segments(CONTENT, 1000))
+    assert read_back(git_dir) == CONTENT
+
+
+@pytest.mark.parametrize('separate', [True, False])
+def test_trailing_data(git_dir, separate):
+    # Bytes after the end of the zlib stream, in a segment of their own or in the last one
+    data = zlib.compress(OBJ)
+    if separate:
+        segments = make_segments(data, 1000, compressed=True) + make_segments(b'garbage', 1000, compressed=True)
+    else:
+        segments = make_segments(data + b'garbage', 1000, compressed=True)
+    with pytest.raises(ValueError):
+        ingest(git_dir, segments)
+    with pytest.raises(FileNotFoundError):
+        open(loose_obj_path(git_dir, OBJ_NAME), 'rb')
+
+
+def test_truncated(git_dir):
+    data = zlib.compress(OBJ)
+    with pytest.raises(ValueError):
+        ingest(git_dir, make_segments(data[:-10], 1000, compressed=True))
+
+
+def test_wrong_digest(git_dir):
+    obj = b'blob ' + f'{len(CONTENT)}'.encode() + b'\x00' + CONTENT[::-1]
+    with pytest.raises(ValueError):
+        ingest(git_dir, make_segments(zlib.compress(obj), 1000, compressed=True))
+    with pytest.raises(ValueError):
+        ingest(git_dir, make_segments(CONTENT + b'x', 1000, obj_size=len(CONTENT)))
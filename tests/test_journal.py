@@ -0,0 +1,72 @@
+import os
+import pytest
+from gitsync.sync import journal
+from gitsync.sync.journal import FetchJournal, JOURNAL_FILE
+
+A, B, C = (bytes([i]) * 20 for i in range(3))
+
+
+@pytest.fixture
+def git_dir(tmp_path):
+    return str(tmp_path)
+
+
+def read_lines(git_dir):
+    with open(os.path.join(git_dir, JOURNAL_FILE)) as f:
+        return f.read().splitlines()
+
+
+def test_load(git_dir):
+    fetch_journal = FetchJournal(git_dir)
+    fetch_journal.append([('commit', A), ('tree', B)])
+    fetch_journal.append([('blob', C)], [B])
+    assert FetchJournal(git_dir).load() == {A: 'commit', C: 'blob'}
+    # Loading rewrites the live entries only
+    assert read_lines(git_dir) == [f'+{A.hex()} commit', f'+{C.hex()} blob']
+
+
+def test_cut_line(git_dir):
+    # A crash in the middle of a line
+    with open(os.path.join(git_dir, JOURNAL_FILE), 'w') as f:
+        f.write(f'+{A.hex()} commit\n+{B.hex()} tree\n-{A.hex()}\n+{C.hex()[:10]}')
+    fetch_journal = FetchJournal(git_dir)
+    assert fetch_journal.load() == {B: 'tree'}
+    # Lines appended after the load are not glued to the cut one
+    fetch_journal.append([('blob', C)])
+    assert FetchJournal(git_dir).load() == {B: 'tree', C: 'blob'}
+
+
+def test_invalid_line(git_dir):
+    with open(os.path.join(git_dir, JOURNAL_FILE), 'w') as f:
+        f.write(f'+{A.hex()} commit\n+xyz tree\n-{B.hex()}\n')
+    assert FetchJournal(git_dir).load() == {A: 'commit'}
+
+
+def test_empty(git_dir):
+    fetch_journal = FetchJournal(git_dir)
+    assert fetch_journal.load() == {}
+    fetch_journal.append([('commit', A)])
+    fetch_journal.append([], [A])
+    assert FetchJournal(git_dir).load() == {}
+    assert not os.path.exists(os.path.join(git_dir, JOURNAL_FILE))
+
+
+def test_maybe_compact(git_dir, monkeypatch):
+    monkeypatch.setattr(journal, 'COMPACT_THRESHOLD', 4)
+    fetch_journal = FetchJournal(git_dir)
+    entries = {}
+    for i in range(3):
+        name = bytes([i + 10]) * 20
+        fetch_journal.append([('blob', name)], [name])
+        fetch_journal.maybe_compact(entries)
+    # Compacted once the lines outnumber the entries
+    assert not os.path.exists(os.path.join(git_dir, JOURNAL_FILE))
+    entries[A] = 'commit'
+    fetch_journal.append([('commit', A)])
+    fetch_journal.append([('blob', B)], [B])
+    fetch_journal.append([('blob', C)], [C])
+    fetch_journal.maybe_compact(entries)
+    assert read_lines(git_dir) == [f'+{A.hex()} commit']
+    # The journal is still appended to after a compaction
+    fetch_journal.append([('tree', B)])
+    assert FetchJournal(git_dir).load() == {A: 'commit', B: 'tree'}
@@ -0,0 +1,119 @@
+import os
+import shutil
+import subprocess
+import pytest
+from gitsync.repos import GitRepos
+from gitsync.sync.merger import Merger
+
+BASE = {
+    'a.txt': 'a\n',
+    'dir/b.txt': 'b\n',
+    'dir/sub/c.txt': 'c\n',
+    'other/d.txt': 'd\n',
+}
+
+
+class Trees:
+    # Commits with given files, written into a bare repo through a separate work tree
+    def __init__(self, tmp_path):
+        self.base_dir = str(tmp_path / 'repos')
+        self.git_dir = os.path.join(self.base_dir, 'src.git')
+        self.work = str(tmp_path / 'work')
+        os.makedirs(self.base_dir)
+        self.git('init', '-q', '--bare', self.git_dir)
+        self.git('-C', self.git_dir, 'config', 'user.email', 'a@example.com')
+        self.git('-C', self.git_dir, 'config', 'user.name', 'a')
+
+    @staticmethod
+    def git(*args) -> str:
+        return subprocess.run(['git', *args], check=True, capture_output=True, text=True).stdout.strip()
+
+    def commit(self, files, parents=()) -> bytes:
+        shutil.rmtree(self.work, ignore_errors=True)
+        for path, content in files.items():
+            os.makedirs(os.path.dirname(os.path.join(self.work, path)), exist_ok=True)
+            with open(os.path.join(self.work, path), 'w') as f:
+                f.write(content)
+        index = os.path.join(self.git_dir, 'index')
+        if os.path.exists(index):
+            os.unlink(index)
+        self.git('-C', self.git_dir, f'--work-tree={self.work}', 'add', '-A')
+        tree = self.git('-C', self.git_dir, 'write-tree')
+        args = [arg for parent in parents for arg in ('-p', parent.hex())]
+        return bytes.fromhex(self.git('-C', self.git_dir, 'commit-tree', tree, *args, '-m', 'commit'))
+
+    def tree(self, commit: bytes) -> bytes:
+        return bytes.fromhex(self.git('-C', self.git_dir, 'rev-parse', f'{commit.hex()}^{{tree}}'))
+
+
+@pytest.fixture
+def trees(tmp_path):
+    return Trees(tmp_path)
+
+
+def merge(trees, ori_files, new_files):
+    base = trees.commit(BASE)
+    ori = trees.commit(ori_files, [base])
+    new = trees.commit(new_files, [base])
+    repo = GitRepos(trees.base_dir)['src.git']
+    merger = Merger(repo)
+    report = merger.merge_trees(trees.tree(base), trees.tree(ori), trees.tree(new))
+    return repo, merger, report, (base, ori, new)
+
+
+def test_merge(trees):
+    ori_files = dict(BASE, **{'a.txt': 'a2\n', 'dir/x.txt': 'x\n'})
+    new_files = dict(BASE, **{'dir/sub/c.txt': 'c2\n', 'dir/y.txt': 'y\n', 'e.txt': 'e\n'})
+    repo, merger, report, (base, ori, new) = merge(trees, ori_files, new_files)
+    assert report.mergeable
+    # The same tree as committing both changes
+    expected = dict(new_files, **{'a.txt': 'a2\n', 'dir/x.txt': 'x\n'})
+    assert report.tree_sha == trees.tree(trees.commit(expected))
+    # Only the changed trees are created: the root, dir and nothing below
+    assert len(report.trees) == 2
+    commit = merger.create_commit(repo.get_commit(base), repo.get_commit(ori), repo.get_commit(new), report)
+    assert trees.git('-C', trees.git_dir, 'rev-parse', f'{commit.hex()}^{{tree}}') == report.tree_sha.hex()
+    assert trees.git('-C', trees.git_dir, 'rev-parse', f'{commit.hex()}^1', f'{commit.hex()}^2').split() == \
+        [ori.hex(), new.hex()]
+    # The new trees are stored
+    files = trees.git('-C', trees.git_dir, 'ls-tree', '-r', '--name-only', commit.hex()).split()
+    assert files == sorted(expected)
+
+
+def test_same_change(trees):
+    files = dict(BASE, **{'a.txt': 'a2\n'})
+    _, _, report, _ = merge(trees, files, dict(files, **{'other/f.txt': 'f\n'}))
+    assert report.mergeable
+    assert report.tree_sha == trees.tree(trees.commit(dict(files, **{'other/f.txt': 'f\n'})))
+
+
+@pytest.mark.parametrize('ori_changes, new_changes, conflict', [
+    ({'a.txt': 'a2\n'}, {'a.txt': 'a3\n'}, ('a.txt', 'changed on both sides')),
+    ({'dir/sub/c.txt': 'c2\n'}, {'dir/sub/c.txt': 'c3\n', 'dir/y.txt': 'y\n'},
+     ('dir/sub/c.txt', 'changed on both sides')),
+    # A file and a tree at the same path
+    ({'dir/z': 'z\n'}, {'dir/z/w.txt': 'w\n'}, ('dir/z', 'changed on both sides')),
+])
+def test_changed_on_both_sides(trees, ori_changes, new_changes, conflict):
+    _, merger, report, _ = merge(trees, dict(BASE, **ori_changes), dict(BASE, **new_changes))
+    assert not report.mergeable
+    assert conflict in report.conflicts
+    with pytest.raises(ValueError):
+        merger.create_commit(None, None, None, report)
+
+
+@pytest.mark.parametrize('deleted, new_changes', [
+    # Deleted on one side, changed on the other
+    ('a.txt', {'a.txt': 'a2\n'}),
+    # Deleted in a subtree which only one side changes
+    ('dir/b.txt', {'other/d.txt': 'd2\n'}),
+    ('dir/sub/c.txt', {'dir/y.txt': 'y\n'}),
+    ('dir/sub/c.txt', {}),
+])
+def test_deleted(trees, deleted, new_changes):
+    ori_files = {path: content for path, content in BASE.items() if path != deleted}
+    for ori_files, new_files in ((ori_files, dict(BASE, **new_changes)), (dict(BASE, **new_changes), ori_files)):
+        _, _, report, _ = merge(trees, ori_files, new_files)
+        assert not report.mergeable
+        assert report.conflicts[0][1] == 'deleted'
+        assert deleted.startswith(report.conflicts[0][0])
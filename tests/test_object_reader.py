@@ -0,0 +1,39 @@
+import os
+import subprocess
+from gitsync.repos import ObjectReader
+
+SEGMENT = 100000
+
+
+def make_packed_blob(tmp_path, size: int):
+    git_dir = str(tmp_path / 'repo.git')
+    subprocess.run(['git', 'init', '-q', '--bare', git_dir], check=True)
+    data = os.urandom(size)
+    blob_path = tmp_path / 'blob'
+    blob_path.write_bytes(data)
+    obj_hex = subprocess.run(['git', '-C', git_dir, 'hash-object', '-w', str(blob_path)],
+                             check=True, capture_output=True, text=True).stdout.strip()
+    subprocess.run(['git', '-C', git_dir, 'repack', '-adq'], check=True)
+    return ObjectReader(os.path.join(git_dir, 'objects')), bytes.fromhex(obj_hex), data
+
+
+def test_sequential_read(tmp_path):
+    reader, obj_name, data = make_packed_blob(tmp_path, 2000000)
+    assert reader.info(obj_name) == ('blob', len(data))
+    for i in range(len(data) // SEGMENT):
+        assert reader.read(obj_name, i * SEGMENT, SEGMENT) == data[i * SEGMENT:(i + 1) * SEGMENT]
+
+
+def test_interleaved_read(tmp_path):
+    # Two consumers at different offsets, as with retransmissions
+    reader, obj_name, data = make_packed_blob(tmp_path, 2000000)
+    for i in range(len(data) // SEGMENT):
+        for j in (i, max(i - 5, 0)):
+            assert reader.read(obj_name, j * SEGMENT, SEGMENT) == data[j * SEGMENT:(j + 1) * SEGMENT]
+
+
+def test_read_past_end(tmp_path):
+    reader, obj_name, data = make_packed_blob(tmp_path, 150000)
+    assert reader.read(obj_name, 100000, SEGMENT) == data[100000:]
+    assert reader.read(obj_name, 200000, SEGMENT) == b''
+    assert reader.read(obj_name, 0, 10) == data[:10]
@@ -0,0 +1,105 @@
+import os
+import subprocess
+import pytest
+from gitsync.repos import GitRepos, write_packed_refs
+
+
+def git(git_dir, *args) -> str:
+    return subprocess.run(['git', '-C', git_dir, *args], check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.fixture
+def repo_dir(tmp_path):
+    # Three commits on main, a loose branch and an annotated tag
+    work = str(tmp_path / 'work')
+    os.makedirs(work)
+    git(work, 'init', '-q', '-b', 'main')
+    git(work, 'config', 'user.email', 'a@example.com')
+    git(work, 'config', 'user.name', 'a')
+    commits = []
+    for name in ['c0', 'c1', 'c2']:
+        git(work, 'commit', '-q', '--allow-empty', '-m', name)
+        commits.append(bytes.fromhex(git(work, 'rev-parse', 'HEAD')))
+    git(work, 'tag', '-a', '-m', 'v1', 'v1', commits[0].hex())
+    base_dir = tmp_path / 'repos'
+    os.makedirs(base_dir)
+    git_dir = str(base_dir / 'src.git')
+    subprocess.run(['git', 'clone', '-q', '--bare', work, git_dir], check=True)
+    git(git_dir, 'pack-refs', '--all')
+    git(git_dir, 'branch', 'loose', commits[1].hex())
+    return str(base_dir), git_dir, commits
+
+
+def for_each_ref(git_dir):
+    lines = git(git_dir, 'for-each-ref', '--format=%(refname) %(objectname)').splitlines()
+    return {ref_name: bytes.fromhex(sha) for ref_name, sha in (line.split(' ') for line in lines)}
+
+
+def test_commit(repo_dir):
+    base_dir, git_dir, c = repo_dir
+    repo = GitRepos(base_dir)['src.git']
+    with repo.ref_transaction() as txn:
+        txn.set_head('refs/heads/main', c[0])
+        txn.set_head('refs/heads/loose', c[2])
+        txn.set_head('refs/heads/new', c[1])
+        txn.del_ref('refs/heads/new')
+        txn.set_head('refs/heads/new', c[2])
+        # Staged heads are visible before the commit, but not on the disk
+        assert repo.get_head('refs/heads/main') == c[0]
+        assert for_each_ref(git_dir)['refs/heads/main'] == c[2]
+    refs = for_each_ref(git_dir)
+    assert refs['refs/heads/main'] == c[0]
+    assert refs['refs/heads/loose'] == c[2]
+    assert refs['refs/heads/new'] == c[2]
+    assert not os.path.exists(os.path.join(git_dir, 'refs', 'heads', 'loose'))
+    assert not os.path.exists(os.path.join(git_dir, 'packed-refs.lock'))
+    # The peeled line of the tag is kept
+    packed = open(os.path.join(git_dir, 'packed-refs')).read()
+    assert f'^{c[0].hex()}\n' in packed
+    assert git(git_dir, 'rev-parse', 'v1^{commit}') == c[0].hex()
+    assert GitRepos(base_dir)['src.git'].get_ref_heads() == repo.get_ref_heads()
+
+
+def test_delete(repo_dir):
+    base_dir, git_dir, c = repo_dir
+    repo = GitRepos(base_dir)['src.git']
+    with repo.ref_transaction() as txn:
+        txn.del_ref('refs/heads/main')
+        txn.del_ref('refs/heads/loose')
+    refs = for_each_ref(git_dir)
+    assert 'refs/heads/main' not in refs
+    assert 'refs/heads/loose' not in refs
+    with pytest.raises(KeyError):
+        repo.get_head('refs/heads/main')
+
+
+def test_abort(repo_dir):
+    base_dir, git_dir, c = repo_dir
+    repo = GitRepos(base_dir)['src.git']
+    heads = dict(repo.get_ref_heads())
+    refs = for_each_ref(git_dir)
+    with pytest.raises(RuntimeError):
+        with repo.ref_transaction() as txn:
+            txn.set_head('refs/heads/main', c[0])
+            txn.set_head('refs/heads/new', c[0])
+            txn.del_ref('refs/heads/loose')
+            raise RuntimeError
+    assert repo.get_ref_heads() == heads
+    assert for_each_ref(git_dir) == refs
+
+
+def test_locked(repo_dir):
+    base_dir, git_dir, c = repo_dir
+    repo = GitRepos(base_dir)['src.git']
+    heads = dict(repo.get_ref_heads())
+    lock_path = os.path.join(git_dir, 'packed-refs.lock')
+    open(lock_path, 'w').close()
+    with pytest.raises(FileExistsError):
+        with repo.ref_transaction() as txn:
+            txn.set_head('refs/heads/main', c[0])
+    # The staged head is rolled back and the lock of the other writer is left alone
+    assert repo.get_ref_heads() == heads
+    assert os.path.exists(lock_path)
+    os.unlink(lock_path)
+    write_packed_refs(git_dir, {'refs/heads/main': c[1]})
+    assert for_each_ref(git_dir)['refs/heads/main'] == c[1]